@@ -2,20 +2,26 @@
 
 import os
 from importlib import import_module
+from time import perf_counter
+
+startup_begin = perf_counter()
 
 from core.config_manager import Config, ConfigManager
+from web.config import WebConfig
 
 if os.path.exists('config.py') or os.path.exists('config'):
     # 导入用户自定义配置
     ConfigManager.load(import_module('config').Config)
+    WebConfig.load(import_module('config').Config)
 
-if Config.DEPLOY_MODE == 'gevent':
+if Config.DEPLOY_MODE in ('gevent', 'async'):
     # 异步
     from gevent import monkey # type: ignore
     monkey.patch_all()
 
 
 import sys
+import logging
 from logging.config import dictConfig
 from multiprocessing import Process, set_start_method
 from traceback import format_exc
@@ -28,14 +34,19 @@ import web.index
 import web.login
 import web.user
 # import webapi
-from core.bundle import BundleDownload
 from core.constant import Constant
-from core.download import UserDownload
-from core.error import ArcError, NoAccess, RateLimit
+from core.error import ArcError
 from core.init import FileChecker
 from core.sql import Connect
 from server.func import error_return
 import web.event_web
+from web.download import bundle_token_cache, download_hit_buffer, download_token_cache
+from web.fileserve import bundle_manifest, send_manifest_file, song_manifest
+from web.jobs import job_runner
+from web.metrics import request_metrics
+from web.schema import ensure_schema
+from web.songhash import song_hash_manifest
+from web.startup import CachedFileChecker, StartupTimer
 
 app = Flask(__name__)
 
@@ -58,10 +69,15 @@ app.register_blueprint(web.login.bp)
 app.register_blueprint(web.index.bp)
 app.register_blueprint(web.user.bp)
 app.register_blueprint(api.bp)
-list(map(app.register_blueprint, server.get_bps()))
+if WebConfig.SERVE_GAME_API:
+    list(map(app.register_blueprint, server.get_bps()))
 app.register_blueprint(web.event_web.bp)
 # app.register_blueprint(webapi.bp)
 
+if WebConfig.REQUEST_METRICS:
+    # 请求耗时统计
+    request_metrics.init_app(app)
+
 @app.route('/')
 def hello():
     return '''
@@ -81,26 +97,22 @@ def favicon():
     return app.send_static_file('favicon.ico')
 
 
-@app.route('/download/<path:file_path>', methods=['GET'])  # 下载
 def download(file_path):
+    # 下载
     with Connect(in_memory=True) as c:
         try:
-            x = UserDownload(c)
-            x.token = request.args.get('t')
-            x.song_id, x.file_name = file_path.split('/', 1)
-            x.select_for_check()
-            if x.is_limited:
-                raise RateLimit(
-                    f'User `{x.user.user_id}` has reached the download limit.', 903)
-            if not x.is_valid:
-                raise NoAccess('Expired token.')
-            x.download_hit()
+            song_id, file_name = file_path.split('/', 1)
+            x = download_token_cache.check(
+                c, request.args.get('t'), song_id, file_name)
+            download_token_cache.hit(x)
             if Config.DOWNLOAD_USE_NGINX_X_ACCEL_REDIRECT:
                 # nginx X-Accel-Redirect
                 response = make_response()
                 response.headers['Content-Type'] = 'application/octet-stream'
                 response.headers['X-Accel-Redirect'] = Config.NGINX_X_ACCEL_REDIRECT_PREFIX + file_path
                 return response
+            if WebConfig.DOWNLOAD_USE_FILE_MANIFEST:
+                return send_manifest_file(song_manifest, file_path)
             return send_from_directory(Constant.SONG_FILE_FOLDER_PATH, file_path, as_attachment=True, conditional=True)
         except ArcError as e:
             if Config.ALLOW_WARNING_LOG:
@@ -109,18 +121,20 @@ def download(file_path):
     return error_return()
 
 
-@app.route('/bundle_download/<string:token>', methods=['GET'])  # 热更新下载
 def bundle_download(token: str):
+    # 热更新下载
     with Connect(in_memory=True) as c_m:
         try:
-            file_path = BundleDownload(c_m).get_path_by_token(
-                token, request.remote_addr)
+            file_path = bundle_token_cache.get_path(
+                c_m, token, request.remote_addr)
             if Config.DOWNLOAD_USE_NGINX_X_ACCEL_REDIRECT:
                 # nginx X-Accel-Redirect
                 response = make_response()
                 response.headers['Content-Type'] = 'application/octet-stream'
                 response.headers['X-Accel-Redirect'] = Config.BUNDLE_NGINX_X_ACCEL_REDIRECT_PREFIX + file_path
                 return response
+            if WebConfig.DOWNLOAD_USE_FILE_MANIFEST:
+                return send_manifest_file(bundle_manifest, file_path)
             return send_from_directory(Constant.CONTENT_BUNDLE_FOLDER_PATH, file_path, as_attachment=True, conditional=True)
         except ArcError as e:
             if Config.ALLOW_WARNING_LOG:
@@ -129,6 +143,13 @@ def bundle_download(token: str):
     return error_return()
 
 
+if WebConfig.SERVE_GAME_API:
+    app.add_url_rule('/download/<path:file_path>',
+                     view_func=download, methods=['GET'])
+    app.add_url_rule('/bundle_download/<string:token>',
+                     view_func=bundle_download, methods=['GET'])
+
+
 if Config.DEPLOY_MODE == 'waitress':
     # 给waitress加个日志
     @app.after_request
@@ -144,6 +165,32 @@ if Config.DEPLOY_MODE == 'waitress':
 #     print(request.data)
 
 
+def install_log_listener():
+    # 写日志文件交给后台线程，请求线程只把日志放入队列
+    if WebConfig.LOG_QUEUE and 'log_listener' not in app.extensions:
+        from web.log_queue import install_log_queue
+        app.extensions['log_listener'] = install_log_queue(
+            logging.getLogger(), WebConfig.LOG_QUEUE_SIZE, WebConfig.LOG_BATCH_SIZE)
+
+
+def worker_start(slot: int):
+    # prefork工作进程开始处理请求前调用，后台线程在fork之后才启动
+    # 后台任务只由slot 0的工作进程执行，被杀死的旧进程留下的任务标记为中断
+    install_log_listener()
+    if slot == 0:
+        job_runner.recover(dead_only=True)
+        job_runner.start()
+
+
+def worker_exit():
+    # 工作进程退出前写入缓冲中的数据
+    if download_hit_buffer is not None:
+        download_hit_buffer.stop()
+    job_runner.stop()
+    if 'log_listener' in app.extensions:
+        app.extensions['log_listener'].stop()
+
+
 def tcp_server_run():
     if Config.DEPLOY_MODE == 'gevent':
         # 异步 gevent WSGI server
@@ -151,6 +198,34 @@ def tcp_server_run():
         app.logger.info('Running gevent WSGI server... (%s:%s)' % host_port)
         from gevent.pywsgi import WSGIServer # type: ignore
         WSGIServer(host_port, app, log=app.logger).serve_forever()
+    elif Config.DEPLOY_MODE == 'async':
+        # gevent处理连接，蓝图中阻塞的数据库与文件操作放到线程池
+        host_port = (Config.HOST, Config.PORT)
+        from web.async_mode import AsyncOffload
+        offload = AsyncOffload(WebConfig.ASYNC_ROUTE_GROUPS, WebConfig.ASYNC_GROUP_LIMITS,
+                               WebConfig.ASYNC_QUEUE_TIMEOUT, WebConfig.ASYNC_FILE_THREADS)
+        app.extensions['async_offload'] = offload
+        app.logger.info(
+            f'Running async WSGI server with {offload.install(app)} offloaded views... (%s:%s)' % host_port)
+        from gevent.pywsgi import WSGIServer # type: ignore
+        WSGIServer(host_port, app, log=app.logger).serve_forever()
+    elif Config.DEPLOY_MODE == 'prefork':
+        # 预派生多进程，每个进程一个线程池式的WSGI server
+        from web.prefork import PreforkServer
+        ssl_context = None
+        if Config.SSL_CERT and Config.SSL_KEY:
+            ssl_context = (Config.SSL_CERT, Config.SSL_KEY)
+        PreforkServer(app, Config.HOST, Config.PORT,
+                      workers=WebConfig.PREFORK_WORKERS,
+                      max_requests=WebConfig.PREFORK_MAX_REQUESTS,
+                      max_requests_jitter=WebConfig.PREFORK_MAX_REQUESTS_JITTER,
+                      timeout=WebConfig.PREFORK_TIMEOUT,
+                      graceful_timeout=WebConfig.PREFORK_GRACEFUL_TIMEOUT,
+                      ssl_context=ssl_context,
+                      on_start=worker_start,
+                      on_exit=worker_exit,
+                      is_busy=lambda: job_runner.running > 0,
+                      logger=app.logger).run()
     elif Config.DEPLOY_MODE == 'waitress':
         # waitress WSGI server
         import logging
@@ -167,8 +242,13 @@ def tcp_server_run():
 
 
 def generate_log_file_dict(level: str, filename: str) -> dict:
+    if WebConfig.LOG_QUEUE and WebConfig.LOG_BATCH_FLUSH:
+        # 由写日志的后台线程每批flush一次
+        handler_class = "web.log_queue.BatchRotatingFileHandler"
+    else:
+        handler_class = "logging.handlers.RotatingFileHandler"
     return {
-        "class": "logging.handlers.RotatingFileHandler",
+        "class": handler_class,
         "maxBytes": 1024 * 1024,
         "backupCount": 1,
         "encoding": "utf-8",
@@ -179,6 +259,8 @@ def generate_log_file_dict(level: str, filename: str) -> dict:
 
 
 def main():
+    timer = StartupTimer(startup_begin)
+    timer.mark('imports')
     log_dict = {
         'version': 1,
         'root': {
@@ -209,12 +291,45 @@ def main():
             'WARNING', './log/warning.log')
 
     dictConfig(log_dict)
+    prefork = Config.DEPLOY_MODE == 'prefork'
+    if prefork and WebConfig.SERVE_GAME_API:
+        # 下载token在每个进程各自的内存数据库中，请求落到其它进程时token无效
+        app.logger.error(
+            "DEPLOY_MODE 'prefork' cannot serve the game API. Set SERVE_GAME_API = False "
+            "and run the game API in a separate single-process instance.")
+        sys.exit(1)
+    if not prefork:
+        # prefork模式下主进程不启动后台线程，由各工作进程自己启动
+        install_log_listener()
+
+    timer.mark('logging')
 
     Connect.logger = app.logger
-    if not FileChecker(app.logger).check_before_run():
+    if WebConfig.SONG_HASH_MANIFEST and not song_hash_manifest.install():
+        app.logger.warning('Song hash manifest is not supported by this server version.')
+    checker = CachedFileChecker(app.logger) if WebConfig.FAST_START else FileChecker(app.logger)
+    if not checker.check_before_run():
         app.logger.error('Some errors occurred. The server will not run.')
         input('Press ENTER key to exit.')
         sys.exit()
+    timer.mark('file check (skipped)' if getattr(checker, 'skipped', False) else 'file check')
+    ensure_schema(app.logger)
+    if song_hash_manifest.dirty:
+        song_hash_manifest.save()
+    n = job_runner.recover()
+    if n:
+        app.logger.warning(f'{n} background jobs were interrupted by the last shutdown.')
+    if prefork:
+        # 主进程只监控工作进程，任务由slot 0的工作进程执行，其它进程只加入队列
+        job_runner.autostart = False
+    else:
+        job_runner.start()
+
+    if WebConfig.DOWNLOAD_USE_FILE_MANIFEST and not Config.DOWNLOAD_USE_NGINX_X_ACCEL_REDIRECT:
+        app.logger.info(
+            f'File manifest: {song_manifest.build()} song files, {bundle_manifest.build()} bundle files.')
+        timer.mark('file manifest')
+    app.logger.info(f'Startup: {timer.summary()}')
 
     if Config.LINKPLAY_HOST and Config.SET_LINKPLAY_SERVER_AS_SUB_PROCESS:
         from linkplay_server import link_play
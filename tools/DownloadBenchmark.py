@@ -0,0 +1,355 @@
+'''
+下载与热更新下载接口的压测脚本，离线可用
+
+用法（在服务端根目录，即main.py所在目录下执行）：
+    python tools/DownloadBenchmark.py run --modes default,gevent,async,waitress
+
+流程：
+1. 在临时目录生成测试用的歌曲文件、热更新文件与数据库（arcaea_database.db）
+2. 对每种DEPLOY_MODE启动一个服务端子进程（本脚本的serve子命令），
+   启动前把用户与下载token写入数据库
+3. 用本地多线程HTTP客户端请求，分别统计冷缓存（每个token只用一次）与
+   热缓存（少量token反复使用）下的 req/s、延迟分位数与吞吐量
+'''
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import secrets
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# prefork模式不提供游戏接口（下载token在每个进程各自的内存数据库中），不参与测试
+MODES = ('default', 'gevent', 'async', 'waitress')
+MODE_REQUIRES = {'gevent': 'gevent', 'async': 'gevent', 'waitress': 'waitress'}
+
+
+# ---------- 测试数据 ----------
+
+def make_files(workdir: str, songs: int, file_size: int, bundles: int, bundle_size: int) -> dict:
+    # 生成歌曲文件与热更新文件，返回文件列表
+    song_dir = os.path.join(workdir, 'songs')
+    bundle_dir = os.path.join(workdir, 'bundle')
+    os.makedirs(song_dir, exist_ok=True)
+    os.makedirs(bundle_dir, exist_ok=True)
+    files = {'songs': [], 'bundles': []}
+    for i in range(songs):
+        song_id = f'bench{i}'
+        os.makedirs(os.path.join(song_dir, song_id), exist_ok=True)
+        with open(os.path.join(song_dir, song_id, 'base.ogg'), 'wb') as f:
+            f.write(os.urandom(file_size))
+        files['songs'].append([song_id, 'base.ogg'])
+    for i in range(bundles):
+        name = f'bench_{i}.bin'
+        with open(os.path.join(bundle_dir, name), 'wb') as f:
+            f.write(os.urandom(bundle_size))
+        files['bundles'].append(name)
+    return files
+
+
+def make_tokens(files: dict, users: int, cold: int, hot: int) -> dict:
+    # cold: 每个token只请求一次；hot: 少量token反复请求
+    def song_tokens(n):
+        r = []
+        for i in range(n):
+            song_id, file_name = files['songs'][i % len(files['songs'])]
+            r.append([i % users + 1, song_id, file_name, secrets.token_urlsafe()])
+        return r
+
+    def bundle_tokens(n):
+        if not files['bundles']:
+            return []
+        return [[files['bundles'][i % len(files['bundles'])], secrets.token_urlsafe()] for i in range(n)]
+
+    return {
+        'users': users,
+        'song': {'cold': song_tokens(cold), 'hot': song_tokens(hot)},
+        'bundle': {'cold': bundle_tokens(cold), 'hot': bundle_tokens(hot)}
+    }
+
+
+def seed_database(tokens: dict) -> None:
+    # 在服务端进程内写入用户与token，下载token在内存数据库中，只能由服务端进程自己写
+    from core.sql import Connect
+    now = int(time.time())
+    with Connect() as c:
+        c.executemany('''insert or ignore into user (user_id, name, user_code, join_date) values (?,?,?,?)''',
+                      [(i, f'bench{i}', f'{i:09d}', now * 1000) for i in range(1, tokens['users'] + 1)])
+    with Connect(in_memory=True) as c_m:
+        rows = tokens['song']['cold'] + tokens['song']['hot']
+        c_m.executemany('''insert or replace into download_token (user_id, song_id, file_name, token, time) values (?,?,?,?,?)''',
+                        [(*x, now) for x in rows])
+        rows = tokens['bundle']['cold'] + tokens['bundle']['hot']
+        try:
+            c_m.executemany('''insert or replace into bundle_download_token (token, file_path, time, device_id) values (?,?,?,?)''',
+                            [(token, file_path, now, 'bench') for file_path, token in rows])
+        except Exception as e:
+            print(f'写入热更新token失败，将跳过热更新下载的测试: {e}', file=sys.stderr)
+
+
+# ---------- 服务端 ----------
+
+def serve(args) -> None:
+    # 以指定的DEPLOY_MODE启动服务端，路径指向临时目录
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    from core.config_manager import Config, ConfigManager
+    overrides = {
+        'DEPLOY_MODE': '' if args.mode == 'default' else args.mode,
+        'HOST': '127.0.0.1',
+        'PORT': args.port,
+        'SSL_CERT': '',
+        'SSL_KEY': '',
+        'LINKPLAY_HOST': '',
+        'ALLOW_INFO_LOG': False,
+        'ALLOW_WARNING_LOG': False,
+        'DOWNLOAD_USE_NGINX_X_ACCEL_REDIRECT': False,
+        'DOWNLOAD_TIMES_LIMIT': 10 ** 9,
+        'SQLITE_DATABASE_PATH': os.path.join(args.workdir, 'arcaea_database.db'),
+        'SONG_FILE_FOLDER_PATH': os.path.join(args.workdir, 'songs') + '/',
+        'CONTENT_BUNDLE_FOLDER_PATH': os.path.join(args.workdir, 'bundle') + '/'
+    }
+
+    def apply_overrides():
+        for k, v in overrides.items():
+            setattr(Config, k, v)
+
+    load = ConfigManager.load
+
+    def load_with_overrides(config):
+        # main.py会先读取用户的config.py，测试用的设置要在其之后生效
+        load(config)
+        apply_overrides()
+
+    ConfigManager.load = staticmethod(load_with_overrides)
+    apply_overrides()
+
+    import main
+    with open(os.path.join(args.workdir, 'tokens.json'), 'r', encoding='utf-8') as f:
+        tokens = json.load(f)
+
+    tcp_server_run = main.tcp_server_run
+
+    def seeded_tcp_server_run():
+        # 数据库初始化完成后、开始监听前写入测试数据
+        seed_database(tokens)
+        tcp_server_run()
+
+    main.tcp_server_run = seeded_tcp_server_run
+    main.main()
+
+
+def start_server(mode: str, port: int, workdir: str) -> subprocess.Popen:
+    log = open(os.path.join(workdir, f'server_{mode}.log'), 'wb')
+    p = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', '--mode', mode,
+                          '--port', str(port), '--workdir', workdir],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if p.poll() is not None:
+            raise RuntimeError(f'服务端已退出，日志见 {log.name}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return p
+        except OSError:
+            time.sleep(0.2)
+    stop_server(p)
+    raise RuntimeError(f'服务端启动超时，日志见 {log.name}')
+
+
+def stop_server(p: subprocess.Popen) -> None:
+    if p.poll() is None:
+        p.send_signal(signal.SIGTERM)
+        try:
+            p.wait(15)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+
+# ---------- 客户端 ----------
+
+def drive(port: int, paths: list, concurrency: int) -> dict:
+    # 多线程请求，每个线程复用一个keep-alive连接
+    lock = threading.Lock()
+    it = iter(paths)
+    latencies = []
+    result = {'bytes': 0, 'errors': 0}
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local_latencies = []
+        size = errors = 0
+        while True:
+            with lock:
+                path = next(it, None)
+            if path is None:
+                break
+            t = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                r = conn.getresponse()
+                n = 0
+                while True:
+                    chunk = r.read(256 * 1024)
+                    if not chunk:
+                        break
+                    n += len(chunk)
+                if r.status != 200:
+                    errors += 1
+                else:
+                    size += n
+                if r.will_close:
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+            local_latencies.append(time.perf_counter() - t)
+        conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            result['bytes'] += size
+            result['errors'] += errors
+
+    t = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+    elapsed = time.perf_counter() - t
+
+    latencies.sort()
+
+    def percentile(q):
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000 if latencies else 0
+
+    return {
+        'requests': len(latencies),
+        'errors': result['errors'],
+        'req/s': len(latencies) / elapsed if elapsed else 0,
+        'p50': percentile(0.5),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'MB/s': result['bytes'] / elapsed / 1024 / 1024 if elapsed else 0
+    }
+
+
+def song_paths(tokens: list) -> list:
+    return [f'/download/{song_id}/{file_name}?t={token}' for _, song_id, file_name, token in tokens]
+
+
+def bundle_paths(tokens: list) -> list:
+    return [f'/bundle_download/{token}' for _, token in tokens]
+
+
+def run_mode(mode: str, args, workdir: str, tokens: dict) -> list:
+    port = args.port
+    p = start_server(mode, port, workdir)
+    rows = []
+    try:
+        for name, make_paths in (('download', song_paths), ('bundle', bundle_paths)):
+            kind = 'song' if name == 'download' else 'bundle'
+            if not tokens[kind]['cold']:
+                continue
+            # 冷缓存：每个token只请求一次
+            rows.append((mode, name, 'cold', drive(
+                port, make_paths(tokens[kind]['cold']), args.concurrency)))
+            # 热缓存：先预热一遍，再反复请求少量token
+            hot = make_paths(tokens[kind]['hot'])
+            drive(port, hot, args.concurrency)
+            paths = [random.choice(hot) for _ in range(args.requests)]
+            rows.append((mode, name, 'hot', drive(
+                port, paths, args.concurrency)))
+    finally:
+        stop_server(p)
+    return rows
+
+
+def print_rows(rows: list) -> None:
+    head = ('mode', 'endpoint', 'cache', 'requests', 'errors',
+            'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'MB/s')
+    print(('{:<10}{:<10}{:<7}' + '{:>10}' * 7).format(*head))
+    for mode, name, cache, r in rows:
+        print(('{:<10}{:<10}{:<7}{:>10}{:>10}' + '{:>10.1f}' * 5).format(
+            mode, name, cache, r['requests'], r['errors'], r['req/s'],
+            r['p50'], r['p95'], r['p99'], r['MB/s']))
+
+
+def run(args) -> None:
+    modes = [x.strip() for x in args.modes.split(',') if x.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            sys.exit(f'未知的模式: {mode}，可选 {", ".join(MODES)}')
+
+    workdir = tempfile.mkdtemp(prefix='arc_bench_')
+    try:
+        files = make_files(workdir, args.songs, args.file_size,
+                           args.bundles, args.bundle_size)
+        rows = []
+        for mode in modes:
+            module = MODE_REQUIRES.get(mode)
+            if module and importlib.util.find_spec(module) is None:
+                print(f'跳过 {mode}：未安装 {module}')
+                continue
+            # 每个模式用一套新的token，冷缓存的结果不受上一个模式影响
+            tokens = make_tokens(files, args.users, args.requests, args.hot_tokens)
+            with open(os.path.join(workdir, 'tokens.json'), 'w', encoding='utf-8') as f:
+                json.dump(tokens, f)
+            if os.path.exists(os.path.join(workdir, 'arcaea_database.db')):
+                os.remove(os.path.join(workdir, 'arcaea_database.db'))
+            print(f'正在测试 {mode} ...')
+            try:
+                rows.extend(run_mode(mode, args, workdir, tokens))
+            except RuntimeError as e:
+                print(f'{mode} 测试失败：{e}')
+        print()
+        print_rows(rows)
+    finally:
+        if args.keep:
+            print(f'测试数据保留在 {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='下载接口压测')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help='生成测试数据并依次测试各部署模式')
+    p.add_argument('--modes', default=','.join(MODES))
+    p.add_argument('--users', type=int, default=100)
+    p.add_argument('--songs', type=int, default=20)
+    p.add_argument('--file-size', type=int, default=1024 * 1024)
+    p.add_argument('--bundles', type=int, default=5)
+    p.add_argument('--bundle-size', type=int, default=4 * 1024 * 1024)
+    p.add_argument('--requests', type=int, default=2000,
+                   help='冷缓存与热缓存各自的请求数')
+    p.add_argument('--hot-tokens', type=int, default=50)
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--port', type=int, default=18080)
+    p.add_argument('--keep', action='store_true', help='保留临时目录')
+
+    p = sub.add_parser('serve', help='内部使用：启动服务端')
+    p.add_argument('--mode', required=True)
+    p.add_argument('--port', type=int, required=True)
+    p.add_argument('--workdir', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        serve(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+from functools import wraps
+
+from flask import copy_current_request_context
+from gevent.lock import BoundedSemaphore  # type: ignore
+from gevent.threadpool import ThreadPool  # type: ignore
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class OffloadedIterable:
+    '''响应体的每次读取都在线程池中进行，大文件下载时不阻塞gevent的事件循环'''
+
+    def __init__(self, iterable, pool: ThreadPool) -> None:
+        self.iterator = iter(iterable)
+        self.iterable = iterable
+        self.pool = pool
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        data = self.pool.apply(next, (self.iterator, None))
+        if data is None:
+            raise StopIteration()
+        return data
+
+    def close(self) -> None:
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+
+class RouteGroup:
+    '''一组路由共用的并发上限，排队超时返回503'''
+
+    def __init__(self, name: str, limit: int, queue_timeout: float) -> None:
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.semaphore = BoundedSemaphore(limit)
+
+        self.active = 0
+        self.waiting = 0
+        self.total = 0
+        self.rejected = 0
+
+    def acquire(self) -> None:
+        self.waiting += 1
+        try:
+            ok = self.semaphore.acquire(timeout=self.queue_timeout)
+        finally:
+            self.waiting -= 1
+        if not ok:
+            self.rejected += 1
+            raise ServiceUnavailable(
+                f'Too many requests in route group `{self.name}`.')
+        self.active += 1
+        self.total += 1
+
+    def release(self) -> None:
+        self.active -= 1
+        self.semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': self.waiting,
+            'total': self.total,
+            'rejected': self.rejected
+        }
+
+
+class AsyncOffload:
+    '''
+        DEPLOY_MODE = 'async' 时使用\
+        连接由gevent处理，指定蓝图或路由的视图函数放到线程池中执行，
+        其中SQLite与文件读写不会阻塞事件循环\
+        `route_groups`: 蓝图名或端点名 -> 路由组名，未列出的路由仍在事件循环中执行\
+        `group_limits`: 路由组名 -> 同时执行的视图数，后台管理的重操作不会占满玩家的名额\
+        `file_threads`: 读取响应中文件内容的线程数\
+        路由组的信号量只在协程中获取与释放；线程池中的视图用到的锁与事件都是原生的，见`web.native`
+    '''
+
+    def __init__(self, route_groups: dict, group_limits: dict, queue_timeout: float = 10,
+                 file_threads: int = 8) -> None:
+        self.route_groups = route_groups
+        self.groups = {name: RouteGroup(name, limit, queue_timeout)
+                       for name, limit in group_limits.items()}
+        self.pool = ThreadPool(max(sum(group_limits.values()), 1))
+        self.file_pool = ThreadPool(max(file_threads, 1))
+
+    def group_of(self, endpoint: str):
+        blueprint = endpoint.rpartition('.')[0]
+        name = self.route_groups.get(blueprint) if blueprint else None
+        if name is None:
+            name = self.route_groups.get(endpoint)
+        return self.groups.get(name)
+
+    def install(self, app) -> int:
+        '''替换app中对应路由的视图函数，需在注册完所有蓝图后调用，返回替换的数量'''
+        n = 0
+        for endpoint, view in list(app.view_functions.items()):
+            group = self.group_of(endpoint)
+            if group is not None:
+                app.view_functions[endpoint] = self.wrap(view, group)
+                n += 1
+        return n
+
+    def wrap(self, view, group: RouteGroup):
+        @wraps(view)
+        def wrapped_view(*args, **kwargs):
+            # 在协程中获取与释放，等待结果时只阻塞当前协程，线程池中的线程不接触gevent的信号量
+            group.acquire()
+            try:
+                rv = self.pool.apply(
+                    copy_current_request_context(view), args, kwargs)
+            finally:
+                group.release()
+            if getattr(rv, 'direct_passthrough', False):
+                # 文件响应，读取放到单独的线程池，不占用路由组的名额
+                rv.response = OffloadedIterable(rv.response, self.file_pool)
+            return rv
+        return wrapped_view
+
+    def stats(self) -> dict:
+        return {name: x.stats() for name, x in self.groups.items()}
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from time import monotonic
+
+from .native import native
+
+
+class TTLCache:
+    '''
+        有界的LRU+TTL缓存，线程安全\
+        超过`maxsize`时淘汰最久未使用的项，每项最多存活`ttl`秒
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data = OrderedDict()  # key -> (expire_at, value)
+        self._lock = native('threading', 'Lock')()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = monotonic()
+        with self._lock:
+            x = self._data.get(key)
+            if x is None:
+                self.misses += 1
+                return default
+            if x[0] <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return x[1]
+
+    def peek(self, key, default=None):
+        # 不计入命中统计，也不影响淘汰顺序
+        x = self._data.get(key)
+        if x is None or x[0] <= monotonic():
+            return default
+        return x[1]
+
+    def set(self, key, value, ttl: float = None) -> None:
+        # ttl只能缩短，不会超过缓存本身的ttl
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            x = self._data.pop(key, None)
+        return default if x is None else x[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0
+        }
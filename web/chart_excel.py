@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.wsgi import wrap_file
+
+from core.config_manager import Config
+from core.constant import Constant
+from core.sql import Connect
+
+from .fileserve import CHUNK_SIZE
+from .native import native
+
+# 定数为0但仍有该难度的曲目
+SP_SONGS = frozenset((
+    'tempestissimo',
+    'infinitestrife',
+    'worldender',
+    'pentiment',
+    'arcanaeden',
+    'testify',
+    'lovelessdress',
+    'last',
+    'lasteternity',
+    'callimakarma',
+    'designant',
+    'astralquant',
+))
+
+HEADER = ('歌曲ID', '歌曲名称', '曲包ID', 'PAST',
+          'PRESENT', 'FUTURE', 'BEYOND', 'ETERNAL')
+FILENAME = 'Arkana数据库定数表.xlsx'
+MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def get_rating(song_id: str, has_diff: bool, data):
+    # 表格中单个难度格的内容
+    if has_diff:
+        if data is not None and (int(data) != 0 or song_id in SP_SONGS):
+            return data
+        return '待填写'
+    if data is not None and int(data) != 0:
+        return '该格应为0而不该有定数：' + str(data)
+    return 0
+
+
+class ChartConstWorkbook:
+    '''
+        定数表的缓存文件，以songlist的修改时间与大小、chart表的摘要为键\
+        键不变时直接发送上次生成的文件，变化时一次查询读出chart表，
+        与songlist合并后用openpyxl的write-only模式流式写出
+    '''
+
+    def __init__(self, path: str = None) -> None:
+        self._path = path
+        self.key = None
+        self._lock = native('threading', 'Lock')()
+
+    @property
+    def path(self) -> str:
+        return self._path or os.path.join(
+            os.path.dirname(Config.SQLITE_DATABASE_PATH) or '.', 'web_chart_const.xlsx')
+
+    @property
+    def key_path(self) -> str:
+        return self.path + '.json'
+
+    @property
+    def songlist_path(self) -> str:
+        return os.path.join(Constant.SONG_FILE_FOLDER_PATH, 'songlist')
+
+    def invalidate(self) -> None:
+        self.key = None
+        try:
+            os.remove(self.key_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _load_charts() -> dict:
+        with Connect() as c:
+            c.execute('''select song_id, rating_pst, rating_prs, rating_ftr, rating_byn, rating_etr from chart''')
+            return {x[0]: x[1:] for x in c.fetchall()}
+
+    def _key(self, charts: dict) -> str:
+        st = os.stat(self.songlist_path)
+        h = hashlib.sha256(f'{st.st_mtime_ns}|{st.st_size}\n'.encode())
+        for song_id in sorted(charts):
+            h.update(repr((song_id, charts[song_id])).encode())
+        return h.hexdigest()
+
+    def _load_key(self):
+        try:
+            with open(self.key_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('key')
+        except (OSError, ValueError):
+            return None
+
+    def rows(self, charts: dict):
+        with open(self.songlist_path, 'r', encoding='utf-8') as f:
+            songs = json.load(f).get('songs', [])
+        for s in songs:
+            song_id = s.get('id')
+            diff_info = {}
+            for diff in s.get('difficulties', []):
+                diff_info.setdefault(diff['ratingClass'], diff.get('rating', 0))
+            data = charts.get(song_id) or (None,) * 5
+            yield (song_id, s.get('title_localized', {}).get('en', ''), s.get('set', ''),
+                   *(get_rating(song_id, diff_info.get(i, 0) != 0, data[i]) for i in range(5)))
+
+    def build(self, charts: dict, key: str) -> None:
+        from openpyxl import Workbook  # 导入较慢，用到时才导入
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Sheet1')
+        header = []
+        for name in HEADER:
+            cell = WriteOnlyCell(ws, value=name)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        ws.append(header)
+        for row in self.rows(charts):
+            ws.append(row)
+
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            wb.save(tmp)
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        with open(self.key_path, 'w', encoding='utf-8') as f:
+            json.dump({'key': key}, f)
+        self.key = key
+
+    def ensure(self) -> str:
+        '''返回最新的缓存文件的键，需要时重新生成'''
+        charts = self._load_charts()
+        key = self._key(charts)
+        if self.key == key and os.path.isfile(self.path):
+            return key
+        with self._lock:
+            if self.key is None:
+                # 重启后沿用上次生成的文件
+                self.key = self._load_key()
+            if self.key != key or not os.path.isfile(self.path):
+                self.build(charts, key)
+        return key
+
+    def send(self) -> Response:
+        key = self.ensure()
+        etag = f'"{key[:32]}"'
+        headers = {
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(FILENAME)}",
+            'ETag': etag,
+        }
+        if request.if_none_match and request.if_none_match.contains(key[:32]):
+            return Response(status=304, headers=headers)
+        f = open(self.path, 'rb')
+        headers['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+        return Response(wrap_file(request.environ, f, CHUNK_SIZE), headers=headers,
+                        mimetype=MIMETYPE, direct_passthrough=True)
+
+
+chart_const_workbook = ChartConstWorkbook()
@@ -0,0 +1,135 @@
+import json
+import os
+import unicodedata
+from bisect import bisect_left
+
+from core.constant import Constant
+from core.sql import Connect
+
+from .config import WebConfig
+from .native import native
+
+# 匹配方式的得分，越高越靠前
+EXACT, PREFIX, SUBSTRING = 3, 2, 1
+# 词条来源的得分，匹配方式相同时歌曲ID优先
+SOURCE_SCORE = {'song_id': 3, 'name': 2, 'title': 1, 'alias': 1}
+
+
+def normalize(s: str) -> str:
+    # 全角转半角、忽略大小写与空白
+    return ''.join(unicodedata.normalize('NFKC', s).casefold().split())
+
+
+class ChartSearchIndex:
+    '''
+        谱面查找索引，词条来自chart表的song_id与name、songlist中的本地化标题与search_title，
+        以及配置中的别名\
+        支持完全匹配、前缀匹配与子串匹配，按匹配方式与词条来源排序返回候选\
+        chart表或songlist变化后调用`invalidate`，下次查找时重建
+    '''
+
+    def __init__(self) -> None:
+        self.charts = {}  # song_id -> name
+        self.terms = {}  # 词条 -> [(song_id, 来源)]
+        self.sorted_terms = []
+        self.songlist_mtime = None
+        self._dirty = True
+        self._lock = native('threading', 'Lock')()
+
+    @property
+    def songlist_path(self) -> str:
+        return os.path.join(Constant.SONG_FILE_FOLDER_PATH, 'songlist')
+
+    def invalidate(self) -> None:
+        self._dirty = True
+
+    def _songlist_mtime(self):
+        try:
+            return os.stat(self.songlist_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _ensure_built(self) -> None:
+        if not self._dirty and self._songlist_mtime() == self.songlist_mtime:
+            return
+        with self._lock:
+            if not self._dirty and self._songlist_mtime() == self.songlist_mtime:
+                return
+            self.build()
+
+    def build(self) -> None:
+        charts = {}
+        terms = {}
+
+        def add(term, song_id, source):
+            term = normalize(term) if isinstance(term, str) else ''
+            if term:
+                terms.setdefault(term, []).append((song_id, source))
+
+        with Connect() as c:
+            c.execute('''select song_id, name from chart''')
+            for song_id, name in c.fetchall():
+                charts[song_id] = name
+                add(song_id, song_id, 'song_id')
+                add(name, song_id, 'name')
+
+        mtime = self._songlist_mtime()
+        if mtime is not None:
+            try:
+                with open(self.songlist_path, 'r', encoding='utf-8') as f:
+                    songs = json.load(f).get('songs', [])
+            except (OSError, ValueError):
+                songs = []
+            for s in songs:
+                song_id = s.get('id')
+                if song_id not in charts:
+                    continue
+                for title in (s.get('title_localized') or {}).values():
+                    add(title, song_id, 'title')
+                for titles in (s.get('search_title') or {}).values():
+                    for title in titles if isinstance(titles, list) else [titles]:
+                        add(title, song_id, 'alias')
+
+        for alias, song_id in WebConfig.CHART_SEARCH_ALIASES.items():
+            if song_id in charts:
+                add(alias, song_id, 'alias')
+
+        self.charts = charts
+        self.terms = terms
+        self.sorted_terms = sorted(terms)
+        self.songlist_mtime = mtime
+        self._dirty = False
+
+    def search(self, query: str, limit: int = 10) -> list:
+        '''返回候选谱面 [{'song_id', 'name', 'score'}]，得分高的在前'''
+        self._ensure_built()
+        q = normalize(query)
+        if not q:
+            return []
+        terms = self.terms
+        sorted_terms = self.sorted_terms
+        best = {}  # song_id -> (得分, 词条长度)
+
+        def hit(term, match):
+            for song_id, source in terms[term]:
+                key = (match * 10 + SOURCE_SCORE[source], -len(term))
+                if song_id not in best or key > best[song_id]:
+                    best[song_id] = key
+
+        if q in terms:
+            hit(q, EXACT)
+        i = bisect_left(sorted_terms, q)
+        while i < len(sorted_terms) and sorted_terms[i].startswith(q):
+            if sorted_terms[i] != q:
+                hit(sorted_terms[i], PREFIX)
+            i += 1
+        for term in sorted_terms:
+            if q in term and not term.startswith(q):
+                hit(term, SUBSTRING)
+
+        r = sorted(best.items(), key=lambda x: (-x[1][0], -x[1][1], x[0]))
+        return [{'song_id': song_id, 'name': self.charts.get(song_id), 'score': key[0]}
+                for song_id, key in r[:limit]]
+
+
+chart_search = ChartSearchIndex()
@@ -0,0 +1,78 @@
+class WebConfig:
+    '''
+        前端扩展功能的配置项\
+        可在config.py的Config中写同名项覆盖默认值
+    '''
+    # 下载token校验缓存
+    # 注意：下载记录在服务端的内存数据库中，每个进程各自一份，下载次数与DOWNLOAD_TIMES_LIMIT也按进程判断，
+    # 多进程部署时一个用户最多可下载DOWNLOAD_TIMES_LIMIT乘以进程数次
+    DOWNLOAD_TOKEN_CACHE_SIZE = 8192
+    DOWNLOAD_TOKEN_CACHE_TTL = 60  # 单位秒，同时受token本身的有效期约束
+    # 下载记录延迟批量写入，关闭时每次下载同步写库
+    DOWNLOAD_HIT_BUFFER = True
+    DOWNLOAD_HIT_FLUSH_INTERVAL = 500  # 单位毫秒
+    DOWNLOAD_HIT_FLUSH_SIZE = 256  # 累计多少条记录时立即写入
+    # 热更新下载token解析缓存
+    BUNDLE_TOKEN_CACHE_SIZE = 4096
+    BUNDLE_TOKEN_CACHE_TTL = 60  # 单位秒，同时受token本身的有效期约束
+    # 未使用nginx X-Accel-Redirect时，按预先构建的文件清单直接发送文件
+    DOWNLOAD_USE_FILE_MANIFEST = True
+    # 是否提供游戏接口（server的蓝图与下载），为False时只提供网页
+    # DEPLOY_MODE = 'prefork' 时必须为False：下载token在每个进程各自的内存数据库中，
+    # 游戏接口需另外以单进程模式部署
+    SERVE_GAME_API = True
+    # DEPLOY_MODE = 'prefork' 时的多进程设置
+    PREFORK_WORKERS = 0  # 工作进程数，为0时等于CPU核数
+    PREFORK_MAX_REQUESTS = 10000  # 工作进程处理多少请求后重启，为0时不重启
+    PREFORK_MAX_REQUESTS_JITTER = 1000  # 随机增加的请求数，错开各进程的重启
+    PREFORK_TIMEOUT = 30  # 心跳超时秒数，超时的工作进程会被杀死并重启
+    PREFORK_GRACEFUL_TIMEOUT = 30  # 平滑退出时等待处理中请求的秒数
+    # DEPLOY_MODE = 'async' 时放到线程池中执行的路由，蓝图名或端点名 -> 路由组
+    ASYNC_ROUTE_GROUPS = {
+        'user': 'player',
+        'event': 'player',
+        'download': 'download',
+        'bundle_download': 'download',
+        'index': 'admin',
+        'login': 'admin'
+    }
+    # 各路由组同时执行的视图数，线程池大小为它们的和
+    ASYNC_GROUP_LIMITS = {'player': 16, 'download': 16, 'admin': 4}
+    ASYNC_QUEUE_TIMEOUT = 10  # 排队等待的秒数，超时返回503
+    ASYNC_FILE_THREADS = 8  # 读取下载文件内容的线程数
+    # 按端点统计请求耗时，后台 /web/metrics 查看
+    REQUEST_METRICS = True
+    # 日志先放入有界队列，由后台线程写入文件，队列满时丢弃
+    LOG_QUEUE = True
+    LOG_QUEUE_SIZE = 10000
+    LOG_BATCH_FLUSH = True  # 开启LOG_QUEUE时，日志文件每批flush一次而不是每条
+    LOG_BATCH_SIZE = 256
+    # 文件与数据库没有变化时跳过启动时的完整检查
+    FAST_START = True
+    # 谱面查找的别名，别名 -> song_id
+    CHART_SEARCH_ALIASES = {}
+    # 后台任务，任务记录保存在单独的数据库文件中，为空时放在游戏数据库旁的web_jobs.db
+    JOB_DATABASE_PATH = ''
+    JOB_WORKERS = 1  # 每个进程执行任务的线程数
+    JOB_POLL_INTERVAL = 1  # 单位秒，空闲时查询新任务的间隔
+    # 重算成绩rating时每个事务处理的行数，以及事务之间暂停的秒数
+    RECOMPUTE_CHUNK_SIZE = 2000
+    RECOMPUTE_PAUSE = 0.01
+    # 歌曲文件md5清单，刷新时只计算变化的文件
+    SONG_HASH_MANIFEST = True
+    SONG_HASH_PROCESSES = 0  # 计算md5的进程数，为0时等于CPU核数
+    # 旧数据库的上传与合并
+    DATABASE_UPLOAD_MAX_SIZE = 1024 * 1024 * 1024  # 单位字节，为0时不限制
+    DATABASE_MERGE_CHUNK_SIZE = 2000  # 每个事务复制的行数
+    DATABASE_MERGE_BACKUP = True  # 合并前备份当前数据库
+    USER_CHAR_CHUNK_SIZE = 200  # 更新user_char_full时每个事务处理的用户数
+    PRESENT_DELIVER_CHUNK_SIZE = 5000  # 给全部用户分发奖励时每个事务处理的user_id范围
+    REDEEM_BATCH_MAX = 100000  # 一次随机生成兑换码的最大数量
+    REDEEM_BATCH_USAGE_TTL = 300  # 单位秒，按批次统计的结果缓存时间，兑换码表有增删时立即失效
+
+    @classmethod
+    def load(cls, config) -> None:
+        # 从用户配置类中读取同名项
+        for k in dir(cls):
+            if k.isupper() and hasattr(config, k):
+                setattr(cls, k, getattr(config, k))
@@ -0,0 +1,219 @@
+import hashlib
+import io
+import os
+import sqlite3
+import time
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+
+from core.config_manager import Config
+from core.constant import Constant
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+# 服务端没有`Constant.DATABASE_MIGRATE_TABLES`时合并的表：玩家数据与后台添加的奖励、兑换码、购买，
+# 不包括chart、character、item等游戏数据表，它们由服务端按游戏数据文件初始化，不能用旧库的数据覆盖
+USER_DATA_TABLES = ('user', 'friend', 'best_score', 'recent30', 'user_world', 'user_item', 'user_save',
+                    'login', 'api_login', 'user_char', 'user_role', 'user_course', 'user_kvdata',
+                    'present', 'present_item', 'user_present', 'redeem', 'redeem_item', 'user_redeem',
+                    'purchase', 'purchase_item')
+
+
+class HashingFile:
+    '''上传的文件边接收边写入磁盘并计算sha256，超过`limit`字节时中止'''
+
+    def __init__(self, path: str, limit: int) -> None:
+        self.path = path
+        self.limit = limit
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.f = open(path, 'wb')
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.limit and self.size > self.limit:
+            raise RequestEntityTooLarge()
+        self.sha256.update(data)
+        return self.f.write(data)
+
+    def seek(self, *args) -> int:
+        # 解析完成后werkzeug会seek(0)，这里不需要再读
+        return 0
+
+    def read(self, *args) -> bytes:
+        return b''
+
+    def close(self) -> None:
+        self.f.close()
+
+
+def receive_upload(environ, path: str, limit: int = 0, names=None):
+    '''
+        流式解析上传表单，文件直接写入`path`，不经过内存或临时文件\
+        返回(表单, 大小, sha256)，没有文件时大小为None\
+        文件名不在`names`中或文件不是SQLite数据库时抛出ValueError
+    '''
+    part = path + '.part'
+    files = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        if not filename:
+            # 未选择文件
+            return io.BytesIO()
+        if files:
+            raise ValueError('Only one file is allowed.')
+        if names and filename not in names:
+            raise ValueError('File name is not allowed.')
+        files.append(HashingFile(part, limit))
+        return files[0]
+
+    try:
+        _, form, _ = parse_form_data(environ, stream_factory=stream_factory,
+                                     max_content_length=limit or None, silent=False)
+    except Exception:
+        for f in files:
+            f.close()
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    if not files:
+        return form, None, None
+
+    f = files[0]
+    f.close()
+    with open(part, 'rb') as x:
+        header = x.read(len(SQLITE_HEADER))
+    if f.size == 0 or header != SQLITE_HEADER:
+        os.remove(part)
+        raise ValueError('Not a SQLite database.')
+    os.replace(part, path)
+    return form, f.size, f.sha256.hexdigest()
+
+
+class DatabaseMerge:
+    '''
+        把旧数据库的数据合并到当前数据库\
+        ATTACH旧库后逐表复制两边都有的列，按rowid分块`insert or replace`，每块单独提交\
+        合并的表与服务端的迁移相同：`Constant.DATABASE_MIGRATE_TABLES`，没有时为`USER_DATA_TABLES`；
+        `UPDATE_WITH_NEW_CHARACTER_DATA`为False时还合并character表\
+        合并前用SQLite的在线备份把当前数据库复制一份，`diff`只统计各表新增、修改与相同的行数
+    '''
+
+    def __init__(self, old_path: str, new_path: str = None, chunk_size: int = 2000,
+                 pause: float = 0.01) -> None:
+        self.old_path = old_path
+        self.new_path = new_path or Config.SQLITE_DATABASE_PATH
+        self.chunk_size = chunk_size
+        self.pause = pause
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.new_path, timeout=30)
+        conn.execute('''attach database ? as old''', (self.old_path,))
+        return conn
+
+    @staticmethod
+    def _columns(conn, schema: str, table: str) -> list:
+        return [(x[1], x[5]) for x in conn.execute(f'''pragma {schema}.table_info("{table}")''')]
+
+    def tables(self, conn) -> list:
+        '''[(表名, 共有的列, 主键列)]'''
+        names = list(getattr(Constant, 'DATABASE_MIGRATE_TABLES', None) or USER_DATA_TABLES)
+        if not Config.UPDATE_WITH_NEW_CHARACTER_DATA and 'character' not in names:
+            # 不使用新的角色数据时保留旧库的角色数据
+            names.append('character')
+        r = []
+        for table in names:
+            old = dict(self._columns(conn, 'old', table))
+            new = self._columns(conn, 'main', table)
+            cols = [name for name, _ in new if name in old]
+            if not cols:
+                continue
+            pk = [name for name, pk in sorted(new, key=lambda x: x[1]) if pk and name in old]
+            r.append((table, cols, pk))
+        return r
+
+    def diff(self, progress=None) -> str:
+        '''各表将新增、修改、不变的行数'''
+        conn = self.connect()
+        try:
+            tables = self.tables(conn)
+            lines = []
+            for n, (table, cols, pk) in enumerate(tables, 1):
+                c = ', '.join(f'"{i}"' for i in cols)
+                total = conn.execute(
+                    f'''select count(*) from old."{table}"''').fetchone()[0]
+                same = conn.execute(f'''select count(*) from (select {c} from old."{table}"
+                    intersect select {c} from main."{table}")''').fetchone()[0]
+                if pk:
+                    on = ' and '.join(f'm."{i}" = o."{i}"' for i in pk)
+                    new = conn.execute(f'''select count(*) from old."{table}" o
+                        where not exists (select 1 from main."{table}" m where {on})''').fetchone()[0]
+                else:
+                    new = total - same
+                lines.append(
+                    f'{table}: {total} rows, {new} new, {total - new - same} changed, {same} unchanged')
+                if progress is not None:
+                    progress(n, len(tables), table)
+            return '\n'.join(lines)
+        finally:
+            conn.close()
+
+    def backup(self, progress=None) -> str:
+        '''在线备份当前数据库，每次复制一部分页，期间不阻塞其他连接的读写'''
+        path = f'{self.new_path}.{time.strftime("%Y%m%d%H%M%S")}.bak'
+        src = sqlite3.connect(self.new_path, timeout=30)
+        dst = sqlite3.connect(path)
+        try:
+            def on_progress(status, remaining, total):
+                if progress is not None:
+                    progress(total - remaining, total, 'backup')
+            src.backup(dst, pages=1024, progress=on_progress, sleep=0.005)
+        finally:
+            dst.close()
+            src.close()
+        return path
+
+    def run(self, progress=None) -> str:
+        '''合并，返回各表复制的行数'''
+        conn = self.connect()
+        try:
+            tables = self.tables(conn)
+            totals = {table: conn.execute(f'''select count(*) from old."{table}"''').fetchone()[0]
+                      for table, _, _ in tables}
+            total = sum(totals.values())
+            done = 0
+            lines = []
+            for table, cols, _ in tables:
+                c = ', '.join(f'"{i}"' for i in cols)
+                n = 0
+                try:
+                    last = -2 ** 63
+                    while True:
+                        # 这一块的最后一个rowid
+                        x = conn.execute(f'''select max(rowid) from (select rowid from old."{table}"
+                            where rowid > ? order by rowid limit ?)''', (last, self.chunk_size)).fetchone()[0]
+                        if x is None:
+                            break
+                        with conn:
+                            rows = conn.execute(f'''insert or replace into main."{table}" ({c})
+                                select {c} from old."{table}" where rowid > ? and rowid <= ?''', (last, x)).rowcount
+                        last = x
+                        n += rows
+                        done += rows
+                        if progress is not None:
+                            progress(done, total, table)
+                        if self.pause:
+                            time.sleep(self.pause)
+                except sqlite3.OperationalError as e:
+                    if 'rowid' not in str(e):
+                        raise
+                    # WITHOUT ROWID的表一次复制
+                    with conn:
+                        n = conn.execute(f'''insert or replace into main."{table}" ({c})
+                            select {c} from old."{table}"''').rowcount
+                    done += n
+                lines.append(f'{table}: {n} rows')
+            return '\n'.join(lines)
+        finally:
+            conn.close()
@@ -0,0 +1,267 @@
+import atexit
+import logging
+import os
+import sqlite3
+from collections import Counter
+from time import time
+
+from core.bundle import BundleDownload
+from core.constant import Constant
+from core.download import UserDownload
+from core.error import NoAccess, RateLimit
+from core.sql import Connect
+from core.user import User
+
+from .cache import TTLCache
+from .config import WebConfig
+from .native import Thread, Wakeup, native
+
+logger = logging.getLogger(__name__)
+
+# 下载记录的列，与服务端`UserDownload.download_hit`写入的相同，缓冲中的记录按这个顺序保存
+# 写入时指定列名，不依赖表中列的顺序
+USER_DOWNLOAD_COLUMNS = ('user_id', 'token', 'time')
+INSERT_USER_DOWNLOAD = f'''insert or ignore into user_download({', '.join(USER_DOWNLOAD_COLUMNS)})
+    values({', '.join('?' * len(USER_DOWNLOAD_COLUMNS))})'''
+
+
+class DownloadHitBuffer:
+    '''
+        下载记录的延迟批量写入\
+        下载记录先在内存中按`USER_DOWNLOAD_COLUMNS`合并，由后台线程每隔`interval`毫秒
+        或累计`batch_size`条时，用一次`executemany`写入`user_download`\
+        `on_flush`: 写入完成后的回调，参数为 user_id -> 本次写入条数
+    '''
+
+    def __init__(self, interval: int = 500, batch_size: int = 256, on_flush=None) -> None:
+        self.interval = interval / 1000
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+
+        self.hits = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.flushes = 0
+
+        self._pending = {}  # USER_DOWNLOAD_COLUMNS的值 -> 合并的下载次数
+        # async模式下视图在原生线程池中调用hit，写入线程也用原生线程
+        self._lock = native('threading', 'Lock')()
+        self._event = Wakeup()
+        self._stopped = False
+        self._thread = None
+        self._pid = None
+
+    def hit(self, user_id: int, token: str) -> None:
+        key = (user_id, token, int(time()))  # 与USER_DOWNLOAD_COLUMNS的顺序相同
+        with self._lock:
+            self.hits += 1
+            if key in self._pending:
+                self._pending[key] += 1
+                self.coalesced += 1
+            else:
+                self._pending[key] = 1
+            n = len(self._pending)
+        self._ensure_started()
+        if n >= self.batch_size:
+            self._event.set()
+
+    def flush(self) -> int:
+        '''立即写入所有待写记录，返回写入条数'''
+        with self._lock:
+            if not self._pending:
+                return 0
+            rows = list(self._pending)
+            self._pending = {}
+
+        users = {}
+        for i in rows:
+            users[i[0]] = users.get(i[0], 0) + 1
+        try:
+            with Connect(in_memory=True) as c_m:
+                c_m.executemany(INSERT_USER_DOWNLOAD, rows)
+        except Exception:
+            # 写入失败则放回队列，等待下次重试
+            with self._lock:
+                for i in rows:
+                    self._pending.setdefault(i, 1)
+            raise
+
+        with self._lock:
+            if self.on_flush is not None:
+                self.on_flush(users)
+            self.flushed += len(rows)
+            self.flushes += 1
+        return len(rows)
+
+    def stop(self) -> None:
+        '''停止后台线程并写入剩余记录，进程退出时调用'''
+        self._stopped = True
+        self._event.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def _ensure_started(self) -> None:
+        # fork出的子进程不会继承线程，需要重新启动
+        if self._pid == os.getpid() or self._stopped:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = Thread(self._run, 'download-hit-flush')
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._event.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush download records.')
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'pending': len(self._pending),
+            'flushed': self.flushed,
+            'flushes': self.flushes
+        }
+
+
+class DownloadTokenCache:
+    '''
+        下载token校验缓存\
+        `tokens`: (token, song_id, file_name) -> (user_id, token_time)\
+        `limited`: user_id -> 服务端`UserDownload.is_limited`的结果，限制的规则只由服务端决定\
+        命中时跳过`select_for_check`与下载次数查询，过期与次数限制照常判断；
+        用户有新的下载记录落库后重新判断，开启`buffer`时最多多放行一次写入间隔内的下载\
+        `buffer`: 下载记录的延迟写入，为None时每次下载同步写库\
+        下载次数只在本进程内统计，与服务端的内存数据库一致，多个进程之间不共享
+    '''
+
+    def __init__(self, maxsize: int = 8192, ttl: float = 60, buffer: DownloadHitBuffer = None) -> None:
+        self.tokens = TTLCache(maxsize, ttl)
+        self.limited = TTLCache(maxsize, ttl)
+        self.buffer = buffer
+        if buffer is not None:
+            buffer.on_flush = self._on_flush
+
+    def check(self, c_m, token: str, song_id: str, file_name: str) -> UserDownload:
+        '''校验下载链接，返回可用的`UserDownload`，无效时抛出异常'''
+        x = UserDownload(c_m)
+        x.token = token
+        x.song_id = song_id
+        x.file_name = file_name
+
+        key = (token, song_id, file_name)
+        r = self.tokens.get(key)
+        if r is None:
+            x.select_for_check()
+            # 缓存不会比token本身活得更久
+            self.tokens.set(key, (x.user.user_id, x.token_time),
+                            x.token_time + Constant.DOWNLOAD_TIME_GAP_LIMIT - time())
+        else:
+            x.user = User()
+            x.user.user_id, x.token_time = r
+
+        if self.is_limited(x):
+            raise RateLimit(
+                f'User `{x.user.user_id}` has reached the download limit.', 903)
+        if not x.is_valid:
+            raise NoAccess('Expired token.')
+        return x
+
+    def is_limited(self, x: UserDownload) -> bool:
+        '''用户是否达到下载上限，由服务端判断，结果按用户缓存'''
+        r = self.limited.get(x.user.user_id)
+        if r is None:
+            r = x.is_limited
+            self.limited.set(x.user.user_id, r)
+        return r
+
+    def hit(self, x: UserDownload) -> None:
+        '''记录一次下载'''
+        if self.buffer is not None:
+            self.buffer.hit(x.user.user_id, x.token)
+            return
+        x.download_hit()
+        self.limited.pop(x.user.user_id)
+
+    def _on_flush(self, users: dict) -> None:
+        # 记录落库后，这些用户在下次校验时重新判断
+        for user_id in users:
+            self.limited.pop(user_id)
+
+    def clear(self) -> None:
+        self.tokens.clear()
+        self.limited.clear()
+
+    def stats(self) -> dict:
+        r = {'tokens': self.tokens.stats(),
+             'limited': self.limited.stats()}
+        if self.buffer is not None:
+            r['hit_buffer'] = self.buffer.stats()
+        return r
+
+
+class BundleTokenCache:
+    '''
+        热更新下载token -> 文件路径的解析缓存\
+        只缓存token到文件路径的查询，首次请求交给`BundleDownload.get_path_by_token`校验；
+        命中时仍按IP经过`BundleDownload.limiter`，与服务端一样只有.cb文件计入次数，超过时返回429\
+        缓存不会比token本身活得更久，token的有效期为`Constant.BUNDLE_DOWNLOAD_TIME_GAP_LIMIT`\
+        `counts`: 每个bundle文件的请求次数，用于观察热更新的推送进度
+    '''
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60) -> None:
+        self.paths = TTLCache(maxsize, ttl)
+        self.counts = Counter()
+        self._lock = native('threading', 'Lock')()
+
+    def get_path(self, c_m, token: str, ip: str) -> str:
+        file_path = self.paths.get(token)
+        if file_path is None:
+            # 服务端校验时已经计入一次下载
+            file_path = BundleDownload(c_m).get_path_by_token(token, ip)
+            self.paths.set(token, file_path, self._token_ttl(c_m, token))
+        elif file_path.endswith('.cb') and not BundleDownload.limiter.hit(ip):
+            raise RateLimit(
+                f'Too many content bundle downloads, IP: {ip}', status=429)
+        with self._lock:
+            self.counts[file_path] += 1
+        return file_path
+
+    @staticmethod
+    def _token_ttl(c_m, token: str):
+        # token剩余的有效时间，查不到时只受缓存本身的ttl约束
+        try:
+            c_m.execute(
+                '''select time from bundle_download_token where token = :a''', {'a': token})
+            x = c_m.fetchone()
+        except sqlite3.Error:
+            return None
+        if not x or x[0] is None:
+            return None
+        return x[0] + Constant.BUNDLE_DOWNLOAD_TIME_GAP_LIMIT - time()
+
+    def clear(self) -> None:
+        self.paths.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts.most_common())
+        return {'paths': self.paths.stats(), 'bundle_requests': counts}
+
+
+download_hit_buffer = DownloadHitBuffer(
+    WebConfig.DOWNLOAD_HIT_FLUSH_INTERVAL, WebConfig.DOWNLOAD_HIT_FLUSH_SIZE) if WebConfig.DOWNLOAD_HIT_BUFFER else None
+if download_hit_buffer is not None:
+    atexit.register(download_hit_buffer.stop)
+
+download_token_cache = DownloadTokenCache(
+    WebConfig.DOWNLOAD_TOKEN_CACHE_SIZE, WebConfig.DOWNLOAD_TOKEN_CACHE_TTL, download_hit_buffer)
+
+bundle_token_cache = BundleTokenCache(
+    WebConfig.BUNDLE_TOKEN_CACHE_SIZE, WebConfig.BUNDLE_TOKEN_CACHE_TTL)
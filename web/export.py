@@ -0,0 +1,57 @@
+import csv
+import io
+import tempfile
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.wsgi import wrap_file
+
+from .fileserve import CHUNK_SIZE
+
+MIMETYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+
+def _csv_lines(header, rows):
+    # 攒够CHUNK_SIZE再发送，开头带BOM以便Excel识别UTF-8
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write('\ufeff')
+    if header:
+        writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CHUNK_SIZE:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
+def export_response(header, rows, fmt: str, filename: str) -> Response:
+    '''
+        把表格以csv或xlsx下载，`rows`可以是生成器\
+        csv边生成边发送；xlsx用openpyxl的write-only模式写入临时文件后发送
+    '''
+    headers = {
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(f'{filename}.{fmt}')}"}
+    if fmt == 'csv':
+        return Response(_csv_lines(header, rows), headers=headers, mimetype=MIMETYPES['csv'])
+    if fmt != 'xlsx':
+        raise ValueError(f'Unknown export format `{fmt}`.')
+
+    from openpyxl import Workbook  # 导入较慢，用到时才导入
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    if header:
+        ws.append(header)
+    for row in rows:
+        ws.append(row)
+    f = tempfile.TemporaryFile()
+    wb.save(f)
+    headers['Content-Length'] = str(f.tell())
+    f.seek(0)
+    return Response(wrap_file(request.environ, f, CHUNK_SIZE), headers=headers,
+                    mimetype=MIMETYPES['xlsx'], direct_passthrough=True)
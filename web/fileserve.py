@@ -0,0 +1,168 @@
+import mimetypes
+import os
+from urllib.parse import quote
+from time import perf_counter
+
+from flask import Response, request
+from werkzeug.exceptions import NotFound
+from werkzeug.http import http_date, quote_etag
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+from core.constant import Constant
+
+from .native import native
+
+CHUNK_SIZE = 256 * 1024
+
+
+class FileManifest:
+    '''
+        目录下所有文件的清单：相对路径 -> (绝对路径, size, mtime, etag, mimetype)\
+        启动时构建一次，刷新谱面或热更新缓存时重建，下载时不再逐个stat与计算响应头
+    '''
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.files = {}
+        self.built = False
+        self.build_time = 0
+        self._lock = native('threading', 'Lock')()
+
+    @staticmethod
+    def _entry(path: str, st: os.stat_result) -> tuple:
+        etag = quote_etag(f'{st.st_mtime_ns:x}-{st.st_size:x}')
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        return (path, st.st_size, int(st.st_mtime), etag, mimetype)
+
+    def build(self) -> int:
+        '''重建清单，返回文件数'''
+        t = perf_counter()
+        files = {}
+        root = os.path.abspath(self.root)
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                rel = os.path.relpath(path, root).replace(os.sep, '/')
+                files[rel] = self._entry(path, st)
+        with self._lock:
+            self.files = files
+            self.built = True
+            self.build_time = perf_counter() - t
+        return len(files)
+
+    def get(self, rel_path: str):
+        '''查询文件信息，不存在时返回None'''
+        if not self.built:
+            self.build()
+        x = self.files.get(rel_path)
+        if x is None:
+            # 清单构建之后新放入的文件
+            path = safe_join(os.path.abspath(self.root), rel_path)
+            if path is None or not os.path.isfile(path):
+                return None
+            x = self._entry(path, os.stat(path))
+            self.files[rel_path] = x
+        return x
+
+    def update(self, rel_path: str, path: str, st: os.stat_result) -> tuple:
+        x = self._entry(path, st)
+        self.files[rel_path] = x
+        return x
+
+
+class RangeFileWrapper:
+    '''只读取文件[start, start + length)部分的可迭代对象'''
+
+    def __init__(self, f, start: int, length: int) -> None:
+        self.f = f
+        self.remaining = length
+        f.seek(start)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        if self.remaining <= 0:
+            raise StopIteration()
+        data = self.f.read(min(CHUNK_SIZE, self.remaining))
+        if not data:
+            raise StopIteration()
+        self.remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        self.f.close()
+
+
+def _is_not_modified(etag: str, mtime: int) -> bool:
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag.strip('"'))
+    if request.if_modified_since:
+        return int(request.if_modified_since.timestamp()) >= mtime
+    return False
+
+
+def send_manifest_file(manifest: FileManifest, rel_path: str) -> Response:
+    '''
+        按清单发送文件，支持条件请求与单段Range\
+        完整文件交给`wsgi.file_wrapper`，服务器支持时可走sendfile零拷贝
+    '''
+    x = manifest.get(rel_path)
+    if x is None:
+        raise NotFound()
+    path, size, mtime, etag, mimetype = x
+
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        raise NotFound()
+    st = os.fstat(f.fileno())
+    if st.st_size != size or int(st.st_mtime) != mtime:
+        # 文件在清单构建后被替换过
+        path, size, mtime, etag, mimetype = manifest.update(rel_path, path, st)
+
+    name = os.path.basename(path)
+    headers = {
+        'Content-Disposition': f'attachment; filename="{name}"' if name.isascii() else f"attachment; filename*=UTF-8''{quote(name)}",
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': http_date(mtime),
+    }
+
+    if _is_not_modified(etag, mtime):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    rng = request.range
+    if rng is not None and 'If-Range' in request.headers:
+        # If-Range不匹配时忽略Range，返回完整文件
+        if request.if_range.etag:
+            if request.if_range.etag != etag.strip('"'):
+                rng = None
+        elif request.if_range.date is None or int(request.if_range.date.timestamp()) != mtime:
+            rng = None
+
+    if rng is not None and len(rng.ranges) == 1:
+        r = rng.range_for_length(size)
+        if r is None:
+            f.close()
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        start, stop = r
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(RangeFileWrapper(f, start, stop - start), status=206, headers=headers,
+                        mimetype=mimetype, direct_passthrough=True)
+
+    headers['Content-Length'] = str(size)
+    return Response(wrap_file(request.environ, f, CHUNK_SIZE), status=200, headers=headers,
+                    mimetype=mimetype, direct_passthrough=True)
+
+
+song_manifest = FileManifest(Constant.SONG_FILE_FOLDER_PATH)
+bundle_manifest = FileManifest(Constant.CONTENT_BUNDLE_FOLDER_PATH)
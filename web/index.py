@@ -6,26 +6,36 @@ import time
 import traceback
 
 from flask import Blueprint, app, current_app, flash, json, make_response, redirect, render_template, request, url_for
-import pandas as pd
 import urllib
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
 from core.error import DataExist, InputError
 from server.func import success_return
+import web.dbmerge
+import web.download
+from web.chart_excel import chart_const_workbook
+from web.chart_search import chart_search
+from web.export import export_response
+from web.jobs import job_runner
+from web.metrics import request_metrics
+from web.recompute import recompute_rating_ptt
+from web.rows import timestr
+from web.scoredelete import ScoreDelete
 import web.system
 import web.webscore
-from core.init import FileChecker 
-from core.operation import (DeleteUserScore, RefreshAllScoreRating, RefreshBundleCache, RefreshSongFileCache, SaveUpdateScore, UnlockUserItem)
-from core.rank import RankList
-from core.score import Potential
+from core.operation import (DeleteUserScore, SaveUpdateScore, UnlockUserItem)
 from core.sql import Connect
 from core.user import User, UserLogin, UserRegister
 from web.login import login_required
+from web.config import WebConfig
 
 UPLOAD_FOLDER = 'database'
 ALLOWED_EXTENSIONS = {'db'}
 
 bp = Blueprint('index', __name__, url_prefix='/web')
+# 查询结果中的时间戳在渲染时才格式化
+bp.add_app_template_filter(timestr, 'timestr')
 
 
 def is_number(s):
@@ -95,76 +105,7 @@ def getinvitecode():
 def getchartconstexcel():
     if request.method == 'POST':
         try:
-            # 读取歌曲数据 - 更新为新的songlist路径
-            with open("./database/songs/songlist", "r", encoding="utf-8") as f:
-                songs = [{
-                    "id": s.get("id"),
-                    "set": s.get("set", ""),
-                    "title_en": s.get("title_localized", {}).get("en", ""),
-                    "difficulties": s.get("difficulties", [])
-                } for s in json.load(f).get("songs", [])]
-
-            # 数据库连接 - 更新为新的数据库路径
-            with sqlite3.connect("./database/arcaea_database.db") as conn:
-                cursor = conn.cursor()
-                result = []
-                for song in songs:
-                    cursor.execute("""
-                        SELECT rating_pst, rating_prs, rating_ftr, rating_byn, rating_etr 
-                        FROM chart WHERE song_id = ?
-                    """, (song["id"],))
-                    data = cursor.fetchone() or [None] * 5
-                    
-                    SP_SPNGS = [
-                        "tempestissimo",
-                        "infinitestrife",
-                        "worldender",
-                        "pentiment",
-                        "arcanaeden",
-                        "testify",
-                        "lovelessdress",
-                        "last",
-                        "lasteternity",
-                        "callimakarma",
-                        "designant",
-                        "astralquant",
-                    ]
-                    diff_info = {}
-                    for diff in song["difficulties"]:
-                        diff_info.setdefault(diff["ratingClass"], diff.get("rating", 0))
-
-                    def get_rating(i, data):
-                        if diff_info.get(i, 0) != 0:
-                            if data is not None and (int(data) != 0 or song["id"] in SP_SPNGS):
-                                return data
-                            else:
-                                return "待填写"
-                        else:
-                            if data is not None and int(data) != 0:
-                                return "该格应为0而不该有定数：" + str(data)
-                            else:
-                                return 0
-                    
-                    result.append({
-                        "歌曲ID": song["id"],
-                        "歌曲名称": song["title_en"],
-                        "曲包ID": song["set"],
-                        "PAST": get_rating(0, data[0]),
-                        "PRESENT": get_rating(1, data[1]),
-                        "FUTURE": get_rating(2, data[2]),
-                        "BEYOND": get_rating(3, data[3]),
-                        "ETERNAL": get_rating(4, data[4]),
-                    })
-            output = BytesIO()
-            pd.DataFrame(result).to_excel(output, index=False, engine='openpyxl')
-            output.seek(0)
-            filename = urllib.parse.quote("Arkana数据库定数表.xlsx")
-            response = make_response(output.getvalue())
-            response.headers.update({
-                "Content-Disposition": f"attachment; filename*=UTF-8''{filename}",
-                "Content-type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            })
-            return response
+            return chart_const_workbook.send()
         except Exception as e:
             print("完整错误信息：", traceback.format_exc()) 
             flash(f"定数表生成失败: {str(e)}")
@@ -231,20 +172,13 @@ def single_player_ptt():
                 if user_id:
                     user_id = user_id[0]
                     user = web.webscore.get_user(c, user_id)
-                    posts = web.webscore.get_user_score(c, user_id, 30)
-                    u = User()
-                    u.user_id = user_id
-                    p = Potential(c, u)
-                    recentptt = p.recent_10 / 10
-                    recent = p.recent_30_to_dict_list()
+                    p = web.webscore.get_user_potential(c, user_id)
+                    posts = p['best_30_list']
+                    recent = p['recent_30_list']
+                    recentptt = p['recent_10']
+                    bestptt = p['best_30']
                     if not posts:
                         error = '没有成绩'
-                    else:
-                        bestptt = 0
-                        for i in posts:
-                            if i['rating']:
-                                bestptt += i['rating']
-                        bestptt = bestptt / 30
                 else:
                     error = '玩家不存在'
 
@@ -259,56 +193,52 @@ def single_player_ptt():
     return render_template('web/singleplayerptt.html')
 
 
+def _player_page_args():
+    # 玩家列表的分页参数：status, after, limit
+    status = request.args.get('status')
+    if status not in ('banned', 'active'):
+        status = None
+    after = None
+    if request.args.get('after'):
+        try:
+            ptt, uid = request.args['after'].split(',')
+            after = (int(ptt), int(uid))
+        except ValueError:
+            after = None
+    limit = request.args.get('limit', 50, type=int)
+    return status, after, min(max(limit, 1), 200)
+
+
+def _player_next(posts: list, limit: int):
+    # 下一页的游标，没有下一页时为None
+    if len(posts) < limit:
+        return None
+    return f"{posts[-1]['rating_ptt']},{posts[-1]['user_id']}"
+
+
 @bp.route('/allplayer', methods=['GET'])
 @login_required
 def all_player():
-    # 所有玩家数据，按照ptt排序
-    error = None
+    # 所有玩家数据，按照ptt排序，分页显示
+    status, after, limit = _player_page_args()
     with Connect() as c:
-        c.execute('''select * from user order by rating_ptt DESC''')
-        x = c.fetchall()
-        if x:
-            posts = []
-            for i in x:
-                join_data = None
-                time_played = None
-                if i[3]:
-                    join_date = time.strftime('%Y-%m-%d %H:%M:%S',
-                                              time.localtime(int(i[3])//1000))
-                if i[20]:
-                    time_played = time.strftime('%Y-%m-%d %H:%M:%S',
-                                                time.localtime(int(i[20])//1000))
-                if i[2] == '':
-                    ban_flag = True
-                else:
-                    ban_flag = False
-
-                posts.append({'name': i[1],
-                              'user_id': i[0],
-                              'join_date': join_date,
-                              'user_code': i[4],
-                              'rating_ptt': i[5],
-                              'song_id': i[11],
-                              'difficulty': i[12],
-                              'score': i[13],
-                              'shiny_perfect_count': i[14],
-                              'perfect_count': i[15],
-                              'near_count': i[16],
-                              'miss_count': i[17],
-                              'time_played': time_played,
-                              'clear_type': i[21],
-                              'rating': i[22],
-                              'ticket': i[26],
-                              'ban_flag': ban_flag
-                              })
-        else:
-            error = '没有玩家数据'
+        posts = web.webscore.get_players(c, status, after, limit)
 
-    if error:
-        flash(error)
-        return render_template('web/allplayer.html')
-    else:
-        return render_template('web/allplayer.html', posts=posts)
+    if not posts:
+        flash('没有玩家数据')
+        return render_template('web/allplayer.html', status=status)
+    return render_template('web/allplayer.html', posts=posts, status=status, limit=limit,
+                           next_after=_player_next(posts, limit), is_first=after is None)
+
+
+@bp.route('/allplayer/json', methods=['GET'])
+@login_required
+def all_player_json():
+    # 玩家列表的分页数据，用于逐页加载
+    status, after, limit = _player_page_args()
+    with Connect() as c:
+        posts = web.webscore.get_players(c, status, after, limit)
+    return success_return({'posts': [i.to_dict(times=True) for i in posts], 'next': _player_next(posts, limit)})
 
 
 @bp.route('/allsong', methods=['GET'])
@@ -351,40 +281,40 @@ def all_song():
 @bp.route('/singlecharttop', methods=['GET', 'POST'])
 @login_required
 def single_chart_top():
-    # 歌曲排行榜
-    if request.method == 'POST':
-        song_name = request.form['sid']
-        difficulty = request.form['difficulty']
-        if difficulty.isdigit():
-            difficulty = int(difficulty)
-        else:
-            difficulty = 0
-        error = None
-        x = None
-        with Connect() as c:
-            song_name = '%'+song_name+'%'
-            c.execute('''select song_id, name from chart where song_id like :a limit 1''',
-                      {'a': song_name})
-            x = c.fetchone()
-
-            if x:
-                y = RankList(c)
-                y.song.set_chart(x[0], difficulty)
-                y.limit = -1
-                y.select_top()
-                posts = y.to_dict_list()
-                for i in posts:
-                    i['time_played'] = time.strftime('%Y-%m-%d %H:%M:%S',
-                                                     time.localtime(i['time_played']))
-            else:
-                error = '查询为空'
+    # 歌曲排行榜，按歌曲ID、名称、本地化标题与别名查找，排行榜分页显示
+    values = request.form if request.method == 'POST' else request.args
+    song_name = values.get('sid', '').strip()
+    if not song_name:
+        return render_template('web/singlecharttop.html')
+    difficulty = values.get('difficulty', '0')
+    difficulty = int(difficulty) if difficulty.isdigit() else 0
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = 50
+
+    candidates = chart_search.search(song_name)
+    if not candidates:
+        flash('查询为空')
+        return render_template('web/singlecharttop.html')
+    x = candidates[0]
+    with Connect() as c:
+        posts = web.webscore.get_chart_top(
+            c, x['song_id'], difficulty, limit, (page - 1) * limit)
+
+    return render_template('web/singlecharttop.html', posts=posts, song_name_en=x['name'], song_id=x['song_id'],
+                           difficulty=difficulty, candidates=candidates[1:], page=page,
+                           has_next=len(posts) == limit)
+
+
+@bp.route('/chartsearch', methods=['GET'])
+@login_required
+def chart_search_json():
+    # 谱面查找的候选列表
+    return success_return(chart_search.search(request.args.get('q', ''), min(request.args.get('limit', 10, type=int), 50)))
 
-        if not error:
-            return render_template('web/singlecharttop.html', posts=posts, song_name_en=x[1], song_id=x[0], difficulty=difficulty)
-        else:
-            flash(error)
 
-    return render_template('web/singlecharttop.html')
+def flash_job(job_id):
+    # 提示任务已加入后台队列
+    flash(f'已加入后台任务 #{job_id}，可在任务列表中查看进度')
 
 
 def allowed_file(filename):
@@ -395,44 +325,53 @@ def allowed_file(filename):
 @bp.route('/updatedatabase', methods=['GET', 'POST'])
 @login_required
 def update_database():
-    # 更新数据库
-    error = None
+    # 更新数据库，上传的文件直接写入磁盘，合并在后台任务中进行
+    path = os.path.join(UPLOAD_FOLDER, 'old_arcaea_database.db')
     if request.method == 'POST':
-        if 'file' not in request.files:
-            flash('没有文件')
+        try:
+            form, size, sha256 = web.dbmerge.receive_upload(
+                request.environ, path, WebConfig.DATABASE_UPLOAD_MAX_SIZE, ['arcaea_database.db'])
+        except RequestEntityTooLarge:
+            flash(
+                f'上传失败：文件不能超过 {WebConfig.DATABASE_UPLOAD_MAX_SIZE // 1024 // 1024} MB')
+            return redirect(request.url)
+        except ValueError:
+            flash('上传失败：只能上传名为 arcaea_database.db 的SQLite数据库')
             return redirect(request.url)
-        file = request.files['file']
-        if file.filename == '':
+        if size is None:
             flash('未选择文件')
             return redirect(request.url)
 
-        if file and allowed_file(file.filename) and file.filename in ['arcaea_database.db']:
-            filename = 'old_' + secure_filename(file.filename)
-            file.save(os.path.join(UPLOAD_FOLDER, filename))
-            flash('上传成功')
-            try:
-                FileChecker.update_database(os.path.join(UPLOAD_FOLDER, filename))
-                flash('数据更新成功')
-            except:
-                flash('数据更新失败')
-        else:
-            error = '上传失败'
+        expected = form.get('sha256', '').strip().lower()
+        if expected and expected != sha256:
+            os.remove(path)
+            flash(f'上传失败：SHA-256不一致，收到的文件为 {sha256}')
+            return redirect(request.url)
+        flash(f'上传成功，{size} 字节，SHA-256: {sha256}')
+        flash_job(job_runner.submit(
+            'update_database', path=path, dry_run='dry_run' in form))
 
-        if error:
-            flash(error)
+    return render_template('web/updatedatabase.html', uploaded=os.path.isfile(path))
 
-    return render_template('web/updatedatabase.html')
+
+@bp.route('/updatedatabase/merge', methods=['POST'])
+@login_required
+def merge_database():
+    # 合并已上传的旧数据库
+    path = os.path.join(UPLOAD_FOLDER, 'old_arcaea_database.db')
+    if os.path.isfile(path):
+        flash_job(job_runner.submit('update_database', path=path,
+                                    dry_run='dry_run' in request.form))
+    else:
+        flash('没有已上传的数据库')
+    return redirect(url_for('index.update_database'))
 
 
 @bp.route('/updatedatabase/refreshsonghash', methods=['POST'])
 @login_required
 def update_song_hash():
     # 更新数据库内谱面文件hash值
-    try:
-        RefreshSongFileCache().run()
-        flash('数据刷新成功')
-    except:
-        flash('Something error!')
+    flash_job(job_runner.submit('refresh_song_file_cache'))
     return render_template('web/updatedatabase.html')
 
 
@@ -441,7 +380,7 @@ def update_song_hash():
 def update_content_bundle():
     # 更新 bundle
     try:
-        RefreshBundleCache().run()
+        web.system.refresh_bundle_cache()
         flash('数据刷新成功')
     except:
         flash('未知错误')
@@ -452,11 +391,69 @@ def update_content_bundle():
 @login_required
 def update_song_rating():
     # 更新所有分数的rating
-    RefreshAllScoreRating().run()
-    flash('数据刷新成功')
+    flash_job(job_runner.submit('refresh_all_score_rating',
+                                only_changed='only_changed' in request.form))
     return render_template('web/updatedatabase.html')
 
 
+@bp.route('/cachestats', methods=['GET'])
+@login_required
+def cache_stats():
+    # 下载相关缓存的命中统计，用于调整缓存大小
+    r = {
+        'download_token': web.download.download_token_cache.stats(),
+        'bundle_token': web.download.bundle_token_cache.stats()
+    }
+    if 'async_offload' in current_app.extensions:
+        # async部署模式下各路由组的并发情况
+        r['route_groups'] = current_app.extensions['async_offload'].stats()
+    return success_return(r)
+
+
+@bp.route('/metrics', methods=['GET'])
+@login_required
+def metrics():
+    # 各端点的请求耗时统计
+    return render_template('web/metrics.html', posts=request_metrics.rows(),
+                           enabled=WebConfig.REQUEST_METRICS)
+
+
+@bp.route('/metrics/prometheus', methods=['GET'])
+@login_required
+def metrics_prometheus():
+    # Prometheus文本格式的请求耗时统计
+    response = make_response(request_metrics.prometheus())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
+@bp.route('/jobs', methods=['GET'])
+@login_required
+def jobs():
+    # 后台任务列表
+    posts = job_runner.list()
+    active = any(x['status'] in ('queued', 'running') for x in posts)
+    return render_template('web/jobs.html', posts=posts, active=active)
+
+
+@bp.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def job_status(job_id):
+    # 单个后台任务的状态
+    return success_return(job_runner.get(job_id))
+
+
+@bp.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    # 取消后台任务
+    if job_runner.cancel(job_id):
+        flash(f'任务 #{job_id} 已取消')
+    else:
+        flash(f'任务 #{job_id} 已结束，无法取消')
+    return redirect(url_for('index.jobs'))
+
+
 @bp.route('/changesong', methods=['GET'])
 @login_required
 def change_song():
@@ -504,6 +501,9 @@ def add_song():
 
     if error:
         flash(error)
+    else:
+        # chart表有变化，谱面查找索引需要重建
+        chart_search.invalidate()
 
     return redirect(url_for('index.change_song'))
 
@@ -526,6 +526,9 @@ def delete_song():
 
     if error:
         flash(error)
+    else:
+        # chart表有变化，谱面查找索引需要重建
+        chart_search.invalidate()
 
     return redirect(url_for('index.change_song'))
 
@@ -641,10 +644,8 @@ def edit_char():
 @login_required
 def update_character():
     # 更新角色数据
-    with Connect() as c:
-        web.system.update_user_char(c)
-
-    flash('数据更新成功')
+    flash_job(job_runner.submit('update_user_char',
+                                only_changed='only_changed' in request.form))
     return redirect(url_for('index.change_character'))
 
 
@@ -758,12 +759,11 @@ def edit_user_purchase():
         if 'name' not in request.form and 'user_code' not in request.form:
             flag = False
             if method == '0':
-                UnlockUserItem().run()
+                flash_job(job_runner.submit('unlock_user_item'))
             else:
                 c.execute(
                     '''delete from user_item where type in ('pack', 'single')''')
-
-            flash("全部用户购买信息修改成功")
+                flash("全部用户购买信息修改成功")
 
         else:
             name = request.form['name']
@@ -892,21 +892,27 @@ def change_item_delete():
     return render_template('web/changeitem.html')
 
 
+def _item_list_page(getter, tables, key, template, error):
+    # 带物品的列表页：summary=1 时只显示数量统计，否则按key分页
+    if request.args.get('summary'):
+        return render_template(template, summary=web.system.get_items_summary(*tables))
+    after = request.args.get('after') or None
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+    posts = getter(after, limit)
+    if not posts:
+        flash(error)
+        return render_template(template)
+    next_after = posts[-1][key] if len(posts) == limit else None
+    return render_template(template, posts=posts, limit=limit, next_after=next_after,
+                           is_first=after is None)
+
+
 @bp.route('/allpurchase', methods=['GET'])
 @login_required
 def all_purchase():
-    # 所有购买数据
-
-    error = None
-    posts = web.system.get_all_purchase()
-    if not posts:
-        error = '没有购买数据'
-
-    if error:
-        flash(error)
-        return render_template('web/allpurchase.html')
-    else:
-        return render_template('web/allpurchase.html', posts=posts)
+    # 所有购买数据，分页显示
+    return _item_list_page(web.system.get_all_purchase, ('purchase', 'purchase_item', 'purchase_name'),
+                           'purchase_name', 'web/allpurchase.html', '没有购买数据')
 
 
 @bp.route('/changepurchase', methods=['GET', 'POST'])
@@ -1092,8 +1098,7 @@ def update_user_save():
         # 全修改
         if 'name' not in request.form and 'user_code' not in request.form:
             flag = False
-            SaveUpdateScore().run()
-            flash("全部用户存档同步成功")
+            flash_job(job_runner.submit('save_update_score'))
 
         else:
             name = request.form['name']
@@ -1133,37 +1138,9 @@ def update_user_save():
 @bp.route('/allpresent', methods=['GET'])
 @login_required
 def all_present():
-    # 所有奖励数据
-
-    error = None
-    with Connect() as c:
-        c.execute('''select * from present''')
-        x = c.fetchall()
-        if x:
-            posts = []
-            for i in x:
-                items = []
-                c.execute(
-                    '''select * from present_item where present_id=?''', (i[0],))
-                y = c.fetchall()
-                for j in y:
-                    if j is not None:
-                        items.append(
-                            {'item_id': j[1], 'type': j[2], 'amount': j[3]})
-
-                posts.append({'present_id': i[0],
-                              'expire_ts': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(i[1])//1000)),
-                              'items': items,
-                              'description': i[2]
-                              })
-        else:
-            error = '没有奖励数据'
-
-    if error:
-        flash(error)
-        return render_template('web/allpresent.html')
-    else:
-        return render_template('web/allpresent.html', posts=posts)
+    # 所有奖励数据，分页显示
+    return _item_list_page(web.system.get_all_present, ('present', 'present_item', 'present_id'),
+                           'present_id', 'web/allpresent.html', '没有奖励数据')
 
 
 @bp.route('/changepresent', methods=['GET'])
@@ -1222,6 +1199,19 @@ def delete_present():
     return redirect(url_for('index.change_present'))
 
 
+def _present_cohort(form):
+    # 分发奖励的筛选条件，PTT按显示值填写，日期为YYYY-MM-DD
+    def ptt(k):
+        return int(round(float(form[k]) * 100)) if form.get(k) else None
+
+    def date(k):
+        return int(datetime.strptime(form[k], '%Y-%m-%d').timestamp() * 1000) if form.get(k) else None
+
+    return {'min_ptt': ptt('min_ptt'), 'max_ptt': ptt('max_ptt'),
+            'join_after': date('join_after'), 'join_before': date('join_before'),
+            'exclude_banned': 'exclude_banned' in form}
+
+
 @bp.route('/deliverpresent', methods=['GET', 'POST'])
 @login_required
 def deliver_present():
@@ -1244,8 +1234,14 @@ def deliver_present():
         # 全修改
         if 'name' not in request.form and 'user_code' not in request.form:
             flag = False
-            web.system.deliver_all_user_present(c, present_id)
-            flash("全部用户奖励分发成功")
+            try:
+                cohort = _present_cohort(request.form)
+            except ValueError:
+                flash('筛选条件格式错误')
+                return render_template('web/deliverpresent.html')
+            n = web.system.deliver_all_user_present(
+                present_id, chunk_size=WebConfig.PRESENT_DELIVER_CHUNK_SIZE, **cohort)
+            flash(f"全部用户奖励分发成功，本次分发给 {n} 名玩家")
         else:
             name = request.form['name']
             user_code = request.form['user_code']
@@ -1281,43 +1277,16 @@ def deliver_present():
 @bp.route('/allredeem', methods=['GET'])
 @login_required
 def all_redeem():
-    # 所有兑换码数据
-
-    error = None
-    with Connect() as c:
-        c.execute('''select * from redeem''')
-        x = c.fetchall()
-        if x:
-            posts = []
-            for i in x:
-                items = []
-                c.execute(
-                    '''select * from redeem_item where code=?''', (i[0],))
-                y = c.fetchall()
-                for j in y:
-                    if j is not None:
-                        items.append(
-                            {'item_id': j[1], 'type': j[2], 'amount': j[3]})
-
-                posts.append({'code': i[0],
-                              'items': items,
-                              'type': i[1]
-                              })
-        else:
-            error = '没有兑换码数据'
-
-    if error:
-        flash(error)
-        return render_template('web/allredeem.html')
-    else:
-        return render_template('web/allredeem.html', posts=posts)
+    # 所有兑换码数据，分页显示
+    return _item_list_page(web.system.get_all_redeem, ('redeem', 'redeem_item', 'code'),
+                           'code', 'web/allredeem.html', '没有兑换码数据')
 
 
 @bp.route('/changeredeem', methods=['GET'])
 @login_required
 def change_redeem():
     # 修改兑换码数据
-    return render_template('web/changeredeem.html')
+    return render_template('web/changeredeem.html', redeem_batch_max=WebConfig.REDEEM_BATCH_MAX)
 
 
 @bp.route('/changeredeem/addredeem', methods=['POST'])
@@ -1350,12 +1319,19 @@ def add_redeem():
         message = web.system.add_one_redeem(
             code, redeem_type, item_id, item_type, item_amount)
     elif redeem_amount and not code:
-        if redeem_amount <= 0 or redeem_amount > 1000:
+        if redeem_amount <= 0 or redeem_amount > WebConfig.REDEEM_BATCH_MAX:
             flash('数量错误')
             return redirect(url_for('index.change_redeem'))
 
-        message = web.system.add_some_random_redeem(
+        message, codes = web.system.add_some_random_redeem(
             redeem_amount, redeem_type, item_id, item_type, item_amount)
+        export = request.form.get('export')
+        if codes and export in ('csv', 'xlsx'):
+            # 直接下载生成的兑换码
+            return export_response(('兑换码', '类型', '物品ID', '物品类型', '数量'),
+                                   ((i, redeem_type, item_id, item_type, item_amount)
+                                    for i in codes),
+                                   export, f'redeem_{item_id}_{len(codes)}')
     elif redeem_amount and code:
         flash('只能使用一种添加方式')
         return redirect(url_for('index.change_redeem'))
@@ -1390,7 +1366,7 @@ def one_redeem(code):
     error = None
     with Connect() as c:
         c.execute(
-            '''select user_id, name, user_code from user where user_id in (select user_id from user_redeem where code=:a)''', {'a': code})
+            '''select u.user_id, u.name, u.user_code from user_redeem r join user u on u.user_id = r.user_id where r.code=:a''', {'a': code})
         x = c.fetchall()
         if x:
             posts = []
@@ -1409,6 +1385,43 @@ def one_redeem(code):
         return render_template('web/redeem.html', posts=posts, code=code)
 
 
+@bp.route('/redeemusage', methods=['GET'])
+@login_required
+def redeem_usage():
+    # 兑换码使用情况统计：batch=1 时按批次统计，否则每个兑换码的使用次数按code分页，export为csv或xlsx时下载
+    used_only = bool(request.args.get('used'))
+    export = request.args.get('export')
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+    if request.args.get('batch'):
+        if export in ('csv', 'xlsx'):
+            return export_response(('类型', '物品', '兑换码数', '已使用的兑换码数', '使用次数'),
+                                   ((i['type'], i['items'], i['codes'], i['used_codes'], i['used'])
+                                    for i in web.system.get_redeem_batch_usage()),
+                                   export, 'redeem_batch_usage')
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        posts = web.system.get_redeem_batch_usage(offset, limit + 1)
+        if not posts:
+            flash('没有兑换码数据')
+            return render_template('web/redeemusage.html', batch=True)
+        next_offset = offset + limit if len(posts) > limit else None
+        return render_template('web/redeemusage.html', batch=True, batches=posts[:limit], limit=limit,
+                               offset=offset, next_offset=next_offset)
+
+    if export in ('csv', 'xlsx'):
+        return export_response(('兑换码', '类型', '使用次数'),
+                               ((i['code'], i['type'], i['used'])
+                                for i in web.system.iter_redeem_usage(used_only)),
+                               export, 'redeem_usage')
+    after = request.args.get('after') or None
+    posts = web.system.get_redeem_usage(after, limit, used_only)
+    if not posts:
+        flash('没有兑换码数据')
+        return render_template('web/redeemusage.html', used=used_only)
+    next_after = posts[-1]['code'] if len(posts) == limit else None
+    return render_template('web/redeemusage.html', posts=posts, limit=limit, next_after=next_after,
+                           is_first=after is None, used=used_only)
+
+
 @bp.route('/changeuserpwd', methods=['GET', 'POST'])
 @login_required
 def edit_userpwd():
@@ -1522,6 +1535,8 @@ def delete_user_score():
                           'a': user_id})
                 c.connection.commit()
                 DeleteUserScore().set_params(user_id=user_id).run()
+                web.webscore.clear_user_potential(c, user_id)
+                recompute_rating_ptt(c, [user_id])
                 flash("用户成绩删除成功")
 
             else:
@@ -1546,61 +1561,41 @@ def change_score():
 @bp.route('/changescore/delete', methods=['POST'])
 @login_required
 def delete_score():
-    # 删除成绩
+    # 删除成绩，先预览受影响的行数，确认后在后台分块删除
 
-    song_id = request.form['sid']
+    song_id = request.form['sid'] or None
     difficulty = request.form['difficulty']
-    if difficulty.isdigit() or difficulty == '-1':
-        difficulty = int(difficulty)
+    difficulty = int(difficulty) if difficulty.isdigit() else None
 
     name = request.form['name']
     user_code = request.form['user_code']
 
-    error = '未知错误'
-    flag = [False, False, False]
-    if song_id:
-        flag[0] = True
-    if difficulty != -1:
-        flag[1] = True
-
-    with Connect() as c:
-        if name or user_code:
+    user_id = None
+    if name or user_code:
+        with Connect() as c:
             if user_code:
                 c.execute('''select user_id from user where user_code=:a''', {
                     'a': user_code})
             else:
                 c.execute(
                     '''select user_id from user where name=:a''', {'a': name})
-
             user_id = c.fetchone()
-            if user_id:
-                user_id = user_id[0]
-                flag[2] = True
-            else:
-                error = '玩家不存在'
+        if not user_id:
+            flash('玩家不存在')
+            return redirect(url_for('index.change_score'))
+        user_id = user_id[0]
 
-        if flag[0] or flag[1] or flag[2]:
-            sql = '''delete from best_score where '''
-            sql_dict = {}
-            if flag[0]:
-                sql += 'song_id=:song_id and '
-                sql_dict['song_id'] = song_id
-            if flag[1]:
-                sql += 'difficulty=:difficulty and '
-                sql_dict['difficulty'] = difficulty
-            if flag[2]:
-                sql += 'user_id=:user_id '
-                sql_dict['user_id'] = user_id
-            if sql[-4:-1] == 'and':
-                sql = sql[:-4]
-
-            c.execute(sql, sql_dict)
-            flash('成功删除成绩')
-            error = None
-        else:
-            error = '输入为空'
+    if song_id is None and difficulty is None and user_id is None:
+        flash('输入为空')
+        return redirect(url_for('index.change_score'))
 
-    if error:
-        flash(error)
+    if 'confirm' not in request.form:
+        preview = ScoreDelete(song_id, difficulty, user_id).preview()
+        if not preview['total']:
+            flash('没有符合条件的成绩')
+            return redirect(url_for('index.change_score'))
+        return render_template('web/changescore.html', preview=preview, form=request.form)
 
+    flash_job(job_runner.submit('delete_scores', song_id=song_id,
+                                difficulty=difficulty, user_id=user_id))
     return redirect(url_for('index.change_score'))
\ No newline at end of file
@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from traceback import format_exc
+
+from core.config_manager import Config
+
+from .config import WebConfig
+from .native import Thread, Wakeup, native
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED, INTERRUPTED = (
+    'queued', 'running', 'done', 'failed', 'cancelled', 'interrupted')
+ACTIVE = (QUEUED, RUNNING)
+
+
+def _alive(pid) -> bool:
+    # 进程是否存在
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobInterrupted(Exception):
+    pass
+
+
+class JobContext:
+    '''
+        传给任务函数的上下文\
+        任务函数调用`progress`报告进度，同时检查是否已被取消，已取消时抛出`JobCancelled`；
+        进程正在退出时抛出`JobInterrupted`
+    '''
+
+    def __init__(self, runner: 'JobRunner', job_id: int) -> None:
+        self.runner = runner
+        self.job_id = job_id
+        self._last = 0
+
+    def progress(self, done: int, total: int = None, message: str = None) -> None:
+        # 至多每`interval`秒写一次库，完成时总是写入
+        if self.runner._stopped:
+            raise JobInterrupted()
+        now = time.monotonic()
+        if now - self._last < self.runner.progress_interval and (total is None or done < total):
+            return
+        self._last = now
+        with self.runner.connect() as conn:
+            conn.execute('''update web_job set done=?, total=coalesce(?, total), message=coalesce(?, message)
+                where job_id=?''', (done, total, message, self.job_id))
+            cancel = conn.execute(
+                '''select cancel from web_job where job_id=?''', (self.job_id,)).fetchone()
+        if cancel and cancel[0]:
+            raise JobCancelled()
+
+
+class JobRunner:
+    '''
+        后台任务\
+        任务保存在单独的数据库文件中，进程重启后排队中的任务继续执行，执行中的任务标记为中断\
+        每个进程有`workers`个线程从库中领取排队的任务；`autostart`为False时`submit`只加入队列，
+        由调用过`start`的进程执行，prefork模式下只有一个工作进程执行任务\
+        进程退出时执行中的任务在下次报告进度时停止，`stop`等待超时后仍未结束的标记为中断\
+        任务函数用`register`按名称注册，参数须能转为JSON
+    '''
+
+    def __init__(self, path: str = None, workers: int = 1, poll_interval: float = 1,
+                 progress_interval: float = 0.5, history: int = 200) -> None:
+        self._path = path
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.history = history
+        self.jobs = {}  # 名称 -> (标题, 函数)
+        self.autostart = True  # submit时在本进程启动执行线程
+        self.running = 0  # 本进程正在执行的任务数
+
+        self._pid = None
+        self._threads = []
+        self._stopped = False
+        self._lock = native('threading', 'Lock')()
+        self._wakeup = Wakeup()
+        self._initialized = False
+
+    @property
+    def path(self) -> str:
+        return self._path or os.path.join(
+            os.path.dirname(Config.SQLITE_DATABASE_PATH) or '.', 'web_jobs.db')
+
+    @contextmanager
+    def connect(self):
+        # 每次操作用新的连接，结束时提交并关闭
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            if not self._initialized:
+                conn.execute('''pragma journal_mode=wal''')
+                conn.execute('''create table if not exists web_job (job_id integer primary key autoincrement,
+                    name text, title text, params text, status text, done integer default 0, total integer,
+                    message text, result text, cancel integer default 0, pid integer,
+                    create_time integer, start_time integer, end_time integer)''')
+                conn.execute(
+                    '''create index if not exists web_job_status on web_job (status, job_id)''')
+                conn.commit()
+                self._initialized = True
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def register(self, name: str, title: str):
+        '''注册任务函数的装饰器，函数签名为 f(ctx, **params)，返回值会转为字符串保存'''
+        def decorator(f):
+            self.jobs[name] = (title, f)
+            return f
+        return decorator
+
+    def submit(self, name: str, **params) -> int:
+        '''加入队列，返回任务ID'''
+        title = self.jobs[name][0]
+        with self.connect() as conn:
+            job_id = conn.execute('''insert into web_job(name, title, params, status, create_time) values(?,?,?,?,?)''',
+                                  (name, title, json.dumps(params), QUEUED, int(time.time() * 1000))).lastrowid
+            conn.execute('''delete from web_job where status not in (?, ?) and job_id <=
+                (select job_id from web_job order by job_id desc limit 1 offset ?)''', (*ACTIVE, self.history))
+        if self.autostart:
+            self.start()
+        self._wakeup.set()
+        return job_id
+
+    def cancel(self, job_id: int) -> bool:
+        '''排队中的任务直接取消，执行中的任务在下次报告进度时停止'''
+        with self.connect() as conn:
+            n = conn.execute('''update web_job set status=?, end_time=? where job_id=? and status=?''',
+                             (CANCELLED, int(time.time() * 1000), job_id, QUEUED)).rowcount
+            n += conn.execute('''update web_job set cancel=1 where job_id=? and status=?''',
+                              (job_id, RUNNING)).rowcount
+        return n > 0
+
+    def get(self, job_id: int):
+        with self.connect() as conn:
+            conn.row_factory = sqlite3.Row
+            x = conn.execute(
+                '''select * from web_job where job_id=?''', (job_id,)).fetchone()
+        return self._to_dict(x) if x else None
+
+    def list(self, limit: int = 50) -> list:
+        with self.connect() as conn:
+            conn.row_factory = sqlite3.Row
+            x = conn.execute(
+                '''select * from web_job order by job_id desc limit ?''', (limit,)).fetchall()
+        return [self._to_dict(i) for i in x]
+
+    @staticmethod
+    def _to_dict(x) -> dict:
+        r = dict(x)
+        r['percent'] = round(r['done'] * 100 / r['total'], 1) if r['total'] else None
+        for k in ('create_time', 'start_time', 'end_time'):
+            r[k] = time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.localtime(r[k] // 1000)) if r[k] else None
+        return r
+
+    def recover(self, dead_only: bool = False) -> int:
+        '''
+            启动时调用，上次退出时仍在执行的任务标记为中断，返回条数\
+            `dead_only`为True时只处理执行进程已不存在的任务，用于其它进程仍在运行时
+        '''
+        with self.connect() as conn:
+            x = conn.execute('''select job_id, pid from web_job where status=?''',
+                             (RUNNING,)).fetchall()
+            ids = [job_id for job_id, pid in x if not dead_only or not _alive(pid)]
+            conn.executemany('''update web_job set status=?, end_time=? where job_id=? and status=?''',
+                             [(INTERRUPTED, int(time.time() * 1000), i, RUNNING) for i in ids])
+        return len(ids)
+
+    def start(self) -> None:
+        # fork出的子进程不会继承线程，需要重新启动
+        if self._pid == os.getpid() or self._stopped:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = [Thread(self._run, f'web-job-{i}')
+                             for i in range(self.workers)]
+            for t in self._threads:
+                t.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        '''不再领取新任务，等待执行中的任务至多`timeout`秒，仍未结束的标记为中断'''
+        self._stopped = True
+        self._wakeup.set()
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(timeout=max(deadline - time.monotonic(), 0))
+        with self.connect() as conn:
+            n = conn.execute('''update web_job set status=?, result=?, end_time=? where status=? and pid=?''',
+                             (INTERRUPTED, 'Worker process exited.', int(time.time() * 1000),
+                              RUNNING, os.getpid())).rowcount
+        if n:
+            logger.warning(f'{n} background jobs were interrupted by shutdown.')
+
+    def _claim(self):
+        with self.connect() as conn:
+            conn.execute('''begin immediate''')
+            x = conn.execute('''select job_id, name, params from web_job where status=? order by job_id limit 1''',
+                             (QUEUED,)).fetchone()
+            if x is not None:
+                conn.execute('''update web_job set status=?, pid=?, start_time=? where job_id=?''',
+                             (RUNNING, os.getpid(), int(time.time() * 1000), x[0]))
+        return x
+
+    def _finish(self, job_id: int, status: str, result=None) -> None:
+        # 完成的任务进度记为100%
+        with self.connect() as conn:
+            conn.execute('''update web_job set status=?, result=?, end_time=?,
+                done=case when ? = ? and total is not null then total else done end where job_id=?''',
+                         (status, None if result is None else str(result), int(time.time() * 1000),
+                          status, DONE, job_id))
+
+    def _run(self) -> None:
+        while not self._stopped:
+            try:
+                x = self._claim()
+            except sqlite3.Error:
+                logger.exception('Failed to claim a job.')
+                x = None
+            if x is None:
+                self._wakeup.wait(self.poll_interval)
+                continue
+
+            job_id, name, params = x
+            if name not in self.jobs:
+                self._finish(job_id, FAILED, f'Unknown job `{name}`.')
+                continue
+            t = time.monotonic()
+            with self._lock:
+                self.running += 1
+            try:
+                r = self.jobs[name][1](JobContext(self, job_id), **json.loads(params))
+                self._finish(job_id, DONE, r)
+                logger.info(
+                    f'Job {job_id} `{name}` done in {time.monotonic() - t:.1f}s.')
+            except JobCancelled:
+                self._finish(job_id, CANCELLED)
+                logger.info(f'Job {job_id} `{name}` cancelled.')
+            except JobInterrupted:
+                self._finish(job_id, INTERRUPTED, 'Worker process exited.')
+                logger.warning(f'Job {job_id} `{name}` interrupted by shutdown.')
+            except Exception:
+                self._finish(job_id, FAILED, format_exc())
+                logger.exception(f'Job {job_id} `{name}` failed.')
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+
+job_runner = JobRunner(WebConfig.JOB_DATABASE_PATH or None, WebConfig.JOB_WORKERS,
+                       WebConfig.JOB_POLL_INTERVAL)
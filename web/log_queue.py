@@ -0,0 +1,146 @@
+import atexit
+import logging
+import os
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Empty, Full, Queue
+
+
+class DroppingQueueHandler(QueueHandler):
+    '''队列满时丢弃日志而不是等待，请求线程永远不会因写日志而阻塞'''
+
+    def __init__(self, queue: Queue) -> None:
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    '''不在每条日志后flush，由`BatchQueueListener`处理完一批日志后统一flush'''
+
+    def flush(self) -> None:
+        pass
+
+    def flush_batch(self) -> None:
+        super().flush()
+
+
+class BatchQueueListener(QueueListener):
+    '''
+        后台线程中写日志\
+        每次最多取出`batch_size`条日志依次交给handler，之后统一flush一次；
+        发现有日志被丢弃时补写一条警告\
+        停止时至多等待`stop_timeout`秒，队列一直是满的也能停止
+    '''
+
+    def __init__(self, queue: Queue, *handlers, batch_size: int = 256,
+                 queue_handler: DroppingQueueHandler = None, stop_timeout: float = 5) -> None:
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.queue_handler = queue_handler
+        self.stop_timeout = stop_timeout
+        self._reported = 0
+
+    def _monitor(self) -> None:
+        q = self.queue
+        while True:
+            try:
+                record = q.get()
+            except Empty:
+                continue
+            stop = record is self._sentinel
+            n = 0
+            while not stop:
+                self.handle(record)
+                n += 1
+                if n >= self.batch_size:
+                    break
+                try:
+                    record = q.get_nowait()
+                except Empty:
+                    break
+                stop = record is self._sentinel
+            self._report_dropped()
+            self._flush()
+            if stop:
+                break
+
+    def stop(self) -> None:
+        # 可重复调用，工作进程退出与atexit都会调用
+        if self._thread is None:
+            return
+        self.enqueue_sentinel()
+        self._thread.join(self.stop_timeout)
+        self._thread = None
+
+    def enqueue_sentinel(self) -> None:
+        # 队列满时先等后台线程腾出位置，仍然满时丢弃最早的日志，计入丢弃数
+        try:
+            self.queue.put(self._sentinel, timeout=self.stop_timeout)
+            return
+        except Full:
+            pass
+        while True:
+            try:
+                self.queue.get_nowait()
+                if self.queue_handler is not None:
+                    self.queue_handler.dropped += 1
+            except Empty:
+                pass
+            try:
+                self.queue.put_nowait(self._sentinel)
+                return
+            except Full:
+                pass
+
+    def _report_dropped(self) -> None:
+        if self.queue_handler is None:
+            return
+        dropped = self.queue_handler.dropped
+        if dropped > self._reported:
+            self.handle(logging.makeLogRecord({
+                'name': __name__,
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': f'Log queue is full, {dropped - self._reported} records dropped.'
+            }))
+            self._reported = dropped
+
+    def _flush(self) -> None:
+        for handler in self.handlers:
+            if isinstance(handler, BatchRotatingFileHandler):
+                handler.flush_batch()
+            else:
+                handler.flush()
+
+    def reset_after_fork(self) -> None:
+        # 子进程中没有写日志的线程，且旧队列的锁可能处于加锁状态，换新队列并重启线程
+        self.queue = Queue(self.queue.maxsize)
+        if self.queue_handler is not None:
+            self.queue_handler.queue = self.queue
+            self.queue_handler.dropped = 0
+        self._reported = 0
+        self._thread = None
+        self.start()
+
+
+def install_log_queue(logger: logging.Logger, maxsize: int = 10000,
+                      batch_size: int = 256) -> BatchQueueListener:
+    '''
+        把`logger`上已有的handler移到后台线程，`logger`只保留一个有界队列的handler\
+        进程退出时写完队列中剩余的日志
+    '''
+    q = Queue(maxsize)
+    queue_handler = DroppingQueueHandler(q)
+    listener = BatchQueueListener(q, *logger.handlers, batch_size=batch_size,
+                                  queue_handler=queue_handler)
+    logger.handlers = [queue_handler]
+    listener.start()
+    atexit.register(listener.stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=listener.reset_after_fork)
+    return listener
@@ -0,0 +1,195 @@
+from time import perf_counter, time
+
+from flask import request
+
+from .native import native
+
+# 耗时分桶的上界，单位秒
+BUCKETS = (0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class EndpointStats:
+    '''单个端点在一个线程内的统计'''
+    __slots__ = ('buckets', 'count', 'time_sum', 'size_sum', 'statuses', 'in_flight')
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS) + 1)  # 最后一个为+Inf
+        self.count = 0
+        self.time_sum = 0.0
+        self.size_sum = 0
+        self.statuses = {}  # status_code -> 次数
+        self.in_flight = 0
+
+    def observe(self, t: float, status: int, size: int) -> None:
+        i = 0
+        while i < len(BUCKETS) and t > BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.time_sum += t
+        self.size_sum += size
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def merge(self, other: 'EndpointStats') -> None:
+        for i, x in enumerate(list(other.buckets)):
+            self.buckets[i] += x
+        self.count += other.count
+        self.time_sum += other.time_sum
+        self.size_sum += other.size_sum
+        for k, v in list(other.statuses.items()):
+            self.statuses[k] = self.statuses.get(k, 0) + v
+        self.in_flight += other.in_flight
+
+    def quantile(self, q: float) -> float:
+        # 在所在分桶内线性插值估算分位数
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, x in enumerate(self.buckets):
+            if seen + x >= rank and x > 0:
+                if i == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[i - 1] if i > 0 else 0
+                return lower + (BUCKETS[i] - lower) * (rank - seen) / x
+            seen += x
+        return BUCKETS[-1]
+
+
+class RequestMetrics:
+    '''
+        按端点统计请求耗时分布、处理中请求数、响应大小与状态码\
+        每个原生线程只写自己的一份统计，请求路径上不加锁，读取时再合并\
+        按原生线程的ident分片：gevent下同一线程中的协程共用一份，协程之间不会在写入中途切换；
+        线程结束后ident会被新线程复用，分片数不超过同时存在的线程数\
+        统计只在本进程内，prefork模式下每个工作进程各自一份
+    '''
+
+    def __init__(self) -> None:
+        self.start_time = time()
+        self._shards = {}  # 线程ident -> {endpoint -> EndpointStats}
+        self._lock = native('threading', 'Lock')()
+        self._get_ident = native('_thread', 'get_ident')
+
+    def init_app(self, app) -> None:
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def _stats(self, endpoint: str) -> EndpointStats:
+        ident = self._get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            # 每个线程只在第一次时加锁
+            with self._lock:
+                shard = self._shards.setdefault(ident, {})
+        x = shard.get(endpoint)
+        if x is None:
+            x = shard[endpoint] = EndpointStats()
+        return x
+
+    def _before_request(self) -> None:
+        endpoint = request.endpoint or '<unmatched>'
+        request.environ['web.metrics'] = [endpoint, perf_counter(), 500, 0]
+        self._stats(endpoint).in_flight += 1
+
+    def _after_request(self, response):
+        x = request.environ.get('web.metrics')
+        if x is not None:
+            x[2] = response.status_code
+            x[3] = response.content_length or 0
+        return response
+
+    def _teardown_request(self, exc) -> None:
+        x = request.environ.pop('web.metrics', None)
+        if x is None:
+            return
+        endpoint, start, status, size = x
+        if exc is not None:
+            status = 500
+        stats = self._stats(endpoint)
+        stats.in_flight -= 1
+        stats.observe(perf_counter() - start, status, size)
+
+    def snapshot(self) -> dict:
+        '''合并所有线程的统计，返回 endpoint -> EndpointStats'''
+        r = {}
+        with self._lock:
+            shards = list(self._shards.values())
+        for stats in shards:
+            for endpoint, x in list(stats.items()):
+                if endpoint not in r:
+                    r[endpoint] = EndpointStats()
+                r[endpoint].merge(x)
+        return r
+
+    def rows(self) -> list:
+        '''供页面展示的统计表，按总耗时降序'''
+        r = []
+        for endpoint, x in self.snapshot().items():
+            r.append({
+                'blueprint': endpoint.rpartition('.')[0] or '-',
+                'endpoint': endpoint,
+                'count': x.count,
+                'in_flight': x.in_flight,
+                'p50': x.quantile(0.5) * 1000,
+                'p95': x.quantile(0.95) * 1000,
+                'p99': x.quantile(0.99) * 1000,
+                'mean': x.time_sum / x.count * 1000 if x.count else 0,
+                'total': x.time_sum,
+                'avg_size': x.size_sum // x.count if x.count else 0,
+                'statuses': ', '.join(f'{k}: {v}' for k, v in sorted(x.statuses.items()))
+            })
+        r.sort(key=lambda i: i['total'], reverse=True)
+        return r
+
+    def prometheus(self) -> str:
+        '''Prometheus文本格式'''
+        snapshot = sorted(self.snapshot().items())
+        lines = [
+            '# HELP web_request_duration_seconds Request latency by endpoint.',
+            '# TYPE web_request_duration_seconds histogram'
+        ]
+        for endpoint, x in snapshot:
+            label = f'endpoint="{_escape(endpoint)}"'
+            n = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), x.buckets):
+                n += count
+                lines.append(
+                    f'web_request_duration_seconds_bucket{{{label},le="{bound}"}} {n}')
+            lines.append(
+                f'web_request_duration_seconds_sum{{{label}}} {x.time_sum}')
+            lines.append(
+                f'web_request_duration_seconds_count{{{label}}} {x.count}')
+
+        lines.append('# HELP web_requests_total Requests by endpoint and status.')
+        lines.append('# TYPE web_requests_total counter')
+        for endpoint, x in snapshot:
+            for status, count in sorted(x.statuses.items()):
+                lines.append(
+                    f'web_requests_total{{endpoint="{_escape(endpoint)}",status="{status}"}} {count}')
+
+        lines.append('# HELP web_response_size_bytes_total Response bytes by endpoint.')
+        lines.append('# TYPE web_response_size_bytes_total counter')
+        for endpoint, x in snapshot:
+            lines.append(
+                f'web_response_size_bytes_total{{endpoint="{_escape(endpoint)}"}} {x.size_sum}')
+
+        lines.append('# HELP web_requests_in_flight Requests being processed.')
+        lines.append('# TYPE web_requests_in_flight gauge')
+        for endpoint, x in snapshot:
+            lines.append(
+                f'web_requests_in_flight{{endpoint="{_escape(endpoint)}"}} {x.in_flight}')
+
+        lines.append('# HELP web_start_time_seconds Process start time.')
+        lines.append('# TYPE web_start_time_seconds gauge')
+        lines.append(f'web_start_time_seconds {self.start_time}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(s: str) -> str:
+    return s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,81 @@
+import threading
+
+
+def patched(module: str = 'threading') -> bool:
+    '''模块是否打过gevent的猴子补丁'''
+    try:
+        from gevent import monkey  # type: ignore
+    except ImportError:
+        return False
+    return monkey.is_module_patched(module)
+
+
+def native(module: str, name: str):
+    '''
+        gevent打过补丁时返回原生的实现，否则返回当前的实现\
+        async模式下视图在原生线程池中执行，它们与协程共用的锁须用原生的，
+        gevent的锁不能跨原生线程使用；需在打补丁之后导入时调用\
+        只适用于Lock这样的底层对象：原始的threading.Thread、Event等类内部仍会用到打过补丁的锁，
+        用下面的`Thread`与`Wakeup`
+    '''
+    if patched(module):
+        from gevent import monkey  # type: ignore
+        return monkey.get_original(module, name)
+    return getattr(__import__(module), name)
+
+
+class Wakeup:
+    '''
+        原生线程之间的唤醒信号，用一把原生锁实现\
+        `wait`等到`set`或超时，返回后自动复位；多个线程等待时一次`set`只唤醒其中一个
+    '''
+
+    def __init__(self) -> None:
+        self._lock = native('threading', 'Lock')()
+        self._lock.acquire()
+
+    def set(self) -> None:
+        try:
+            self._lock.release()
+        except RuntimeError:
+            # 已经set过，还没有线程取走
+            pass
+
+    def wait(self, timeout: float) -> bool:
+        return self._lock.acquire(timeout=timeout)
+
+
+class NativeThread:
+    '''
+        gevent打过补丁时threading.Thread在协程中执行，阻塞的数据库操作会卡住事件循环，
+        从线程池中启动时甚至不会运行；这里用原始的`start_new_thread`启动真正的线程，只提供`start`与`join`
+    '''
+
+    def __init__(self, target, name: str = None) -> None:
+        self.target = target
+        self.name = name
+        self._done = native('threading', 'Lock')()
+
+    def start(self) -> None:
+        self._done.acquire()
+        native('_thread', 'start_new_thread')(self._run, ())
+
+    def _run(self) -> None:
+        try:
+            self.target()
+        finally:
+            self._done.release()
+
+    def join(self, timeout: float = None) -> None:
+        if self._done.acquire(timeout=-1 if timeout is None else timeout):
+            self._done.release()
+
+    def is_alive(self) -> bool:
+        return self._done.locked()
+
+
+def Thread(target, name: str = None):
+    '''后台线程，gevent打过补丁时为`NativeThread`，否则为普通的守护线程'''
+    if patched('threading'):
+        return NativeThread(target, name)
+    return threading.Thread(target=target, name=name, daemon=True)
@@ -0,0 +1,277 @@
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import socketserver
+import threading
+from multiprocessing import Array
+from time import sleep, time
+
+from werkzeug.serving import make_server
+
+
+class PreforkServer:
+    '''
+        预派生多进程部署\
+        每个工作进程用SO_REUSEPORT各自监听同一端口，由内核分配连接；
+        主进程负责按心跳监控工作进程、重启退出或失去响应的进程\
+        `max_requests`: 工作进程处理这么多请求后被替换，为0时不限制\
+        信号：SIGHUP 平滑重启所有工作进程，SIGTERM/SIGINT 停止；
+        `is_busy`返回True的进程（如后台任务正在执行）在任务结束后才被替换，停止时则不等待，
+        被中断的任务由任务队列标记为中断\
+        后台线程不要在主进程中启动，fork时它们持有的锁会以不确定的状态被复制；
+        由`on_start(slot)`在每个工作进程中启动\
+        注意：内存数据库是每个进程各自一份，依赖它的状态（如游戏接口的下载token）不在进程间共享，
+        因此这一模式不能提供游戏接口
+    '''
+
+    def __init__(self, app, host: str, port: int, workers: int = 0, max_requests: int = 0,
+                 max_requests_jitter: int = 0, timeout: int = 30, graceful_timeout: int = 30,
+                 ssl_context=None, backlog: int = 2048, on_start=None, on_exit=None, is_busy=None,
+                 logger=None) -> None:
+        self.app = app
+        self.host = host
+        self.port = int(port)
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.timeout = timeout
+        self.graceful_timeout = graceful_timeout
+        self.ssl_context = ssl_context
+        self.backlog = backlog
+        self.on_start = on_start  # 工作进程开始处理请求前调用，参数为slot，用于启动后台线程
+        self.on_exit = on_exit  # 工作进程退出前调用，用于写入缓冲的数据
+        self.is_busy = is_busy  # 返回True时推迟按请求数的替换，如后台任务正在执行
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.slots = {}  # slot -> pid
+        self.retiring = {}  # pid -> 强制结束的时间
+        self.heartbeats = None  # 各slot工作进程最近一次心跳的时间
+        self.recycle = None  # 各slot请求被替换的工作进程pid，以pid区分，已被替换的旧进程写入时不影响新进程
+        self.busy = None  # 各slot工作进程是否忙，由工作进程随心跳更新
+        self.reload_pending = set()  # 平滑重启时因忙而推迟替换的slot
+        self._stopping = False
+        self._reloading = False
+
+    # ---------- 主进程 ----------
+
+    def run(self) -> None:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('SO_REUSEPORT is not supported on this platform.')
+        self.heartbeats = Array('d', self.workers, lock=False)
+        self.recycle = Array('i', self.workers, lock=False)
+        self.busy = Array('b', self.workers, lock=False)
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+
+        self.logger.info(
+            f'Running prefork server with {self.workers} workers... ({self.host}:{self.port})')
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        while not self._stopping:
+            sleep(1)
+            self._reap()
+            if self._reloading:
+                self._reloading = False
+                self.logger.info('Reloading workers...')
+                self.reload_pending.update(self.slots)
+            self._reload()
+            self._recycle()
+            self._check_workers()
+
+        self._shutdown()
+
+    def _handle_stop(self, signum, frame) -> None:
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame) -> None:
+        self._reloading = True
+
+    def _spawn(self, slot: int) -> None:
+        self.heartbeats[slot] = time()
+        self.recycle[slot] = 0
+        self.busy[slot] = 0
+        self.reload_pending.discard(slot)  # 新进程不需要再被平滑重启
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._worker(slot)
+            except BaseException:
+                self.logger.exception(f'Worker {os.getpid()} crashed.')
+                code = 1
+            finally:
+                os._exit(code)
+        self.slots[slot] = pid
+        self.logger.info(f'Worker {pid} started in slot {slot}.')
+
+    def _reap(self) -> None:
+        # 只回收自己的工作进程，不影响Link Play等其它子进程
+        for pid in list(self.retiring):
+            if self._exit_status(pid) is not None:
+                del self.retiring[pid]
+        for slot, pid in list(self.slots.items()):
+            status = self._exit_status(pid)
+            if status is None:
+                continue
+            del self.slots[slot]
+            if not self._stopping:
+                self.logger.info(
+                    f'Worker {pid} exited with status {status}, restarting.')
+                self._spawn(slot)
+
+    @staticmethod
+    def _exit_status(pid: int):
+        # 进程已退出时返回退出状态，否则返回None
+        try:
+            x, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            return -1
+        return status if x == pid else None
+
+    def _check_workers(self) -> None:
+        now = time()
+        for slot, pid in list(self.slots.items()):
+            if now - self.heartbeats[slot] > self.timeout:
+                self.logger.warning(
+                    f'Worker {pid} missed heartbeat for {self.timeout}s, killing.')
+                self._kill(pid, signal.SIGKILL)
+        for pid, deadline in list(self.retiring.items()):
+            if now > deadline:
+                self._kill(pid, signal.SIGKILL)
+
+    def _reload(self) -> None:
+        # 先启动新进程再让旧进程处理完手头的请求后退出，端口始终有进程在监听
+        # 忙的进程留在reload_pending中，空闲后再替换，不中断执行中的后台任务
+        for slot in list(self.reload_pending):
+            pid = self.slots.get(slot)
+            if pid is None:
+                self.reload_pending.discard(slot)
+                continue
+            if self.busy[slot]:
+                continue
+            self._spawn(slot)
+            self._retire(pid)
+
+    def _recycle(self) -> None:
+        # 处理请求数达到上限的工作进程，同样先启动替换进程
+        for slot, pid in list(self.slots.items()):
+            if self.recycle[slot] == pid:
+                self.logger.info(
+                    f'Worker {pid} reached max requests, replacing.')
+                self._spawn(slot)
+                self._retire(pid)
+
+    def _retire(self, pid: int) -> None:
+        self.retiring[pid] = time() + self.graceful_timeout
+        self._kill(pid, signal.SIGTERM)
+
+    @staticmethod
+    def _kill(pid: int, sig: int) -> None:
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _shutdown(self) -> None:
+        self.logger.info('Stopping workers...')
+        for pid in list(self.slots.values()):
+            self._retire(pid)
+        self.slots = {}
+        while self.retiring:
+            self._reap()
+            self._check_workers()
+            sleep(0.1)
+        self.logger.info('Prefork server stopped.')
+
+    # ---------- 工作进程 ----------
+
+    def _worker(self, slot: int) -> None:
+        random.seed()
+        state = {'requests': 0, 'connections': 0, 'stop': False}
+        lock = threading.Lock()
+
+        def handle_stop(signum, frame):
+            state['stop'] = True
+
+        signal.signal(signal.SIGTERM, handle_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if self.on_start is not None:
+            self.on_start(slot)
+
+        pid = os.getpid()
+        limit = self.max_requests
+        if limit and self.max_requests_jitter:
+            # 错开各进程的重启时间
+            limit += random.randint(0, self.max_requests_jitter)
+
+        def app(environ, start_response):
+            with lock:
+                state['requests'] += 1
+                if limit and state['requests'] >= limit and not state['stop'] and \
+                        self.recycle[slot] != pid and (self.is_busy is None or not self.is_busy()):
+                    # 通知主进程先启动替换进程，收到SIGTERM前照常处理请求
+                    self.recycle[slot] = pid
+            return self.app(environ, start_response)
+
+        sock = socket.socket(
+            socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        server = make_server(self.host, self.port, app, threaded=True,
+                             ssl_context=self.ssl_context, fd=sock.fileno())
+        sock.close()
+
+        # 按连接计数，已接受但还没开始处理的连接也要等它结束
+        process_request_thread = server.process_request_thread
+
+        def counted_process_request_thread(request, client_address):
+            try:
+                process_request_thread(request, client_address)
+            finally:
+                with lock:
+                    state['connections'] -= 1
+
+        def process_request(request, client_address):
+            with lock:
+                state['connections'] += 1
+            try:
+                socketserver.ThreadingMixIn.process_request(
+                    server, request, client_address)
+            except BaseException:
+                with lock:
+                    state['connections'] -= 1
+                raise
+
+        server.process_request_thread = counted_process_request_thread
+        server.process_request = process_request
+
+        # 接受连接的循环同时负责心跳，循环卡住时主进程会发现
+        # 收到SIGTERM后不再写心跳，slot可能已属于替换进程，退出期间由retiring的期限约束
+        server.timeout = 0.5
+        while not state['stop']:
+            self.heartbeats[slot] = time()
+            if self.is_busy is not None:
+                self.busy[slot] = self.is_busy()
+            server.handle_request()
+        # 处理已在监听队列中的连接，关闭监听后它们会被内核丢弃
+        while select.select([server], [], [], 0)[0]:
+            server.handle_request()
+        server.server_close()
+
+        # 等待处理中的连接结束
+        deadline = time() + self.graceful_timeout
+        while state['connections'] > 0 and time() < deadline:
+            sleep(0.1)
+        self.logger.info(
+            f"Worker {os.getpid()} exiting after {state['requests']} requests.")
+        if self.on_exit is not None:
+            self.on_exit()
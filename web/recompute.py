@@ -0,0 +1,221 @@
+import time
+
+from core.constant import Constant
+from core.score import Potential, Score
+from core.sql import Connect
+from core.user import User
+
+from .webscore import clear_user_potential
+
+DIFFICULTIES = ('rating_pst', 'rating_prs', 'rating_ftr', 'rating_byn', 'rating_etr')
+
+
+class ScoreRatingRecompute:
+    '''
+        分块重算best_score与recent30的rating，再重算玩家的rating_ptt\
+        谱面定数一次读入，song_id -> 5个难度的定数；每块最多`chunk_size`行，
+        算出的rating与原值不同的行用一次`executemany`写回，每块单独提交，块之间暂停`pause`秒让出数据库\
+        `only_changed`为True时只重算定数与上次快照不同的谱面，没有快照时全部重算；
+        rating_ptt只重算有rating变化的玩家，全部重算时重算所有玩家，同时删除这些玩家的ptt详情缓存\
+        recent30为每条记录一行（有song_id、difficulty、score列）时才能重算，否则跳过\
+        计算方式与`Score.calculate_rating`一致，不在chart表中的谱面rating为0
+    '''
+
+    def __init__(self, chunk_size: int = 2000, pause: float = 0.01, only_changed: bool = False) -> None:
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.only_changed = only_changed
+
+        self.charts = {}  # song_id -> (定数 * 5)
+        self.scanned = 0
+        self.updated = 0
+        self.total = 0
+        self.recent_updated = 0
+        self.users = set()  # rating有变化的玩家
+        self.ptt_users = 0
+        self.elapsed = 0
+
+    @staticmethod
+    def _defnum(x):
+        # 没有定数或定数不大于0的谱面，rating为0
+        return float(x) / 10 if x is not None and x > 0 else None
+
+    def load_charts(self) -> None:
+        with Connect() as c:
+            c.execute(
+                f'''select song_id, {', '.join(DIFFICULTIES)} from chart''')
+            self.charts = {x[0]: tuple(self._defnum(i) for i in x[1:])
+                           for x in c.fetchall()}
+
+    def changed_songs(self):
+        '''定数与快照不同的谱面，包括已删除的谱面；没有快照时返回None'''
+        with Connect() as c:
+            c.execute(
+                f'''select song_id, {', '.join(DIFFICULTIES)} from web_chart_snapshot''')
+            snapshot = {x[0]: tuple(self._defnum(i) for i in x[1:])
+                        for x in c.fetchall()}
+        if not snapshot:
+            return None
+        r = [k for k, v in self.charts.items() if snapshot.get(k) != v]
+        r.extend(k for k in snapshot if k not in self.charts)
+        return r
+
+    def save_snapshot(self, songs=None) -> None:
+        with Connect() as c:
+            if songs is None:
+                c.execute('''delete from web_chart_snapshot''')
+                c.execute(
+                    f'''insert into web_chart_snapshot select song_id, {', '.join(DIFFICULTIES)} from chart''')
+            else:
+                for song_id in songs:
+                    c.execute(
+                        '''delete from web_chart_snapshot where song_id=?''', (song_id,))
+                    c.execute(f'''insert into web_chart_snapshot select song_id, {', '.join(DIFFICULTIES)}
+                        from chart where song_id=?''', (song_id,))
+
+    def ratings(self, rows: list) -> list:
+        '''一块(rowid, song_id, difficulty, score, rating, user_id)，返回需要写回的[(rating, rowid)]'''
+        charts = self.charts
+        calculate = Score.calculate_rating
+        none = (None,) * 5
+        r = []
+        for rowid, song_id, difficulty, score, old, user_id in rows:
+            defnum = charts.get(song_id, none)[difficulty] if difficulty is not None and 0 <= difficulty < 5 else None
+            rating = max(calculate(defnum, score), 0) if defnum is not None and score is not None else 0
+            if old is None or abs(rating - old) > 1e-9:
+                r.append((rating, rowid))
+                self.users.add(user_id)
+        return r
+
+    def _chunks(self, where: str = '', args: tuple = (), table: str = 'best_score'):
+        # 按rowid分块读取
+        last = 0
+        while True:
+            with Connect() as c:
+                c.execute(f'''select rowid, song_id, difficulty, score, rating, user_id from {table}
+                    where rowid > ? {where} order by rowid limit ?''', (last, *args, self.chunk_size))
+                rows = c.fetchall()
+            if not rows:
+                return
+            yield rows
+            last = rows[-1][0]
+
+    def run(self, progress=None) -> str:
+        '''`progress(done, total, message)`为进度回调，返回统计信息'''
+        t = time.monotonic()
+        self.load_charts()
+        songs = self.changed_songs() if self.only_changed else None
+
+        with Connect() as c:
+            if songs is None:
+                c.execute('''select count(*) from best_score''')
+            else:
+                c.execute(f'''select count(*) from best_score where song_id in ({','.join('?' * len(songs))})''',
+                          songs)
+            self.total = c.fetchone()[0]
+
+        if songs is None:
+            sources = [self._chunks()]
+        else:
+            sources = [self._chunks('and song_id = ?', (i,)) for i in songs]
+
+        for chunks in sources:
+            for rows in chunks:
+                updates = self.ratings(rows)
+                if updates:
+                    with Connect() as c:
+                        c.executemany(
+                            '''update best_score set rating=? where rowid=?''', updates)
+                self.scanned += len(rows)
+                self.updated += len(updates)
+                self.elapsed = time.monotonic() - t
+                if progress is not None:
+                    progress(self.scanned, self.total, self.summary())
+                if self.pause:
+                    time.sleep(self.pause)
+
+        self.update_recent30(songs, progress)
+        self.update_rating_ptt(songs is None, progress)
+        self.save_snapshot(songs)
+        self.elapsed = time.monotonic() - t
+        return self.summary()
+
+    def update_recent30(self, songs=None, progress=None) -> None:
+        '''重算recent30中对应谱面的rating'''
+        with Connect() as c:
+            c.execute('''pragma table_info(recent30)''')
+            cols = {x[1] for x in c.fetchall()}
+        if not {'song_id', 'difficulty', 'score', 'rating'} <= cols:
+            return
+        if songs is None:
+            sources = [self._chunks(table='recent30')]
+        else:
+            sources = [self._chunks('and song_id = ?', (i,), 'recent30') for i in songs]
+        for chunks in sources:
+            for rows in chunks:
+                updates = self.ratings(rows)
+                if updates:
+                    with Connect() as c:
+                        c.executemany(
+                            '''update recent30 set rating=? where rowid=?''', updates)
+                self.recent_updated += len(updates)
+                if progress is not None:
+                    progress(self.scanned, self.total, f'recent30: {self.recent_updated} updated')
+                if self.pause:
+                    time.sleep(self.pause)
+
+    def update_rating_ptt(self, all_users: bool = False, progress=None) -> None:
+        '''重算rating有变化的玩家的rating_ptt，`all_users`为True时重算所有玩家，并删除ptt详情缓存'''
+        if all_users:
+            with Connect() as c:
+                c.execute('''select user_id from user''')
+                users = [x[0] for x in c.fetchall()]
+        else:
+            users = sorted(self.users)
+        for i in range(0, len(users), 500):
+            chunk = users[i:i + 500]
+            with Connect() as c:
+                recompute_rating_ptt(c, chunk)
+                if not all_users:
+                    # 触发器不存在时也不会读到旧的缓存
+                    for user_id in chunk:
+                        clear_user_potential(c, user_id)
+            self.ptt_users += len(chunk)
+            if progress is not None:
+                progress(i + len(chunk), len(users), f'rating_ptt: {self.ptt_users} users')
+            if self.pause:
+                time.sleep(self.pause)
+        if all_users:
+            with Connect() as c:
+                clear_user_potential(c)
+
+    def summary(self) -> str:
+        speed = self.scanned / self.elapsed if self.elapsed else 0
+        return (f'{self.scanned} rows scanned, {self.updated} updated, {self.recent_updated} recent30 updated, '
+                f'{self.ptt_users} users rating_ptt, {self.elapsed:.1f}s, {speed:.0f} rows/s')
+
+
+def recompute_rating_ptt(c, user_ids, chunk_size: int = 500) -> int:
+    '''
+        重算指定玩家的rating_ptt，返回玩家数\
+        best30的和用一次窗口函数查询一批玩家，recent10仍由`Potential`计算
+    '''
+    best_weight = getattr(Constant, 'BEST30_WEIGHT', 1 / 40)
+    recent_weight = getattr(Constant, 'RECENT10_WEIGHT', 1 / 40)
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        c.execute(f'''select user_id, sum(rating) from (select user_id, rating,
+            row_number() over (partition by user_id order by rating desc) as r
+            from best_score where user_id in ({','.join('?' * len(chunk))})) where r <= 30 group by user_id''', chunk)
+        best = dict(c.fetchall())
+        rows = []
+        for user_id in chunk:
+            u = User()
+            u.user_id = user_id
+            value = (best.get(user_id) or 0) * best_weight + \
+                Potential(c, u).recent_10 * recent_weight
+            rows.append((int(value * 100), user_id))
+        c.executemany(
+            '''update user set rating_ptt=? where user_id=?''', rows)
+    return len(user_ids)
@@ -0,0 +1,84 @@
+import time
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def timestr(value, fmt: str = TIME_FORMAT):
+    # 秒级时间戳格式化，作为模板过滤器在渲染时调用；为空时返回None，已是字符串时原样返回(旧的缓存)
+    if not value:
+        return None
+    if isinstance(value, str):
+        return value
+    return time.strftime(fmt, time.localtime(value))
+
+
+class Record:
+    '''
+        以列名访问的一行数据，具体的类只能用`record`生成，只有__slots__没有__dict__\
+        `row['列名']`与`row.列名`都可以用，模板与原来返回字典时的写法相同
+    '''
+    __slots__ = ()
+    _fields = ()
+    _times = ()  # 秒级时间戳的列
+    select = ''  # 查询时的列表达式，`make`与它一起由`record`生成
+
+    @classmethod
+    def fetchall(cls, c) -> list:
+        return list(map(cls.make, c.fetchall()))
+
+    @classmethod
+    def fetchone(cls, c):
+        x = c.fetchone()
+        return cls.make(x) if x is not None else None
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self) -> tuple:
+        return self._fields
+
+    def to_dict(self, times: bool = False) -> dict:
+        '''转为字典，用于json；`times`为True时时间戳转为字符串'''
+        r = {k: getattr(self, k) for k in self._fields}
+        if times:
+            for k in self._times:
+                r[k] = timestr(r[k])
+        return r
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, k) == getattr(other, k) for k in self._fields)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({", ".join(f"{k}={getattr(self, k)!r}" for k in self._fields)})'
+
+
+def record(name: str, columns, times=()) -> type:
+    '''
+        生成`Record`的子类\
+        `columns`为列表达式，如`score`、`password = '' as ban_flag`，属性名取`as`之后的部分，
+        查询时用`select`只取这些列，`make`把一行按顺序赋给各属性，与namedtuple一样编译成一个函数
+    '''
+    columns = tuple(columns)
+    fields = tuple(i.rsplit(' as ', 1)[-1].strip().rsplit('.', 1)[-1]
+                   for i in columns)
+    for i in fields:
+        if not i.isidentifier():
+            raise ValueError(f'Invalid field name `{i}`.')
+    cls = type(name, (Record,), {'__slots__': fields, '_fields': fields,
+                                 '_times': tuple(times), 'select': ', '.join(columns)})
+    ns = {'_new': object.__new__, '_cls': cls}
+    exec(f'''def make(row):
+    self = _new(_cls)
+    {', '.join(f'self.{i}' for i in fields)}, = row
+    return self''', ns)
+    cls.make = staticmethod(ns['make'])
+    return cls
@@ -0,0 +1,95 @@
+import sqlite3
+
+from core.config_manager import Config
+
+# 前端用到的表、索引与触发器，建在服务端的数据库上，不改动已有的表
+TABLES = (
+    # 玩家ptt详情的缓存，best_score或recent30变化时由触发器删除对应的行，下次查询时重新计算
+    '''create table if not exists web_user_potential (user_id integer primary key, best_30 real, recent_10 real,
+        best_30_list text, recent_30_list text, update_time integer)''',
+    # 上次重算rating时的谱面定数，用于只重算定数变化的谱面
+    '''create table if not exists web_chart_snapshot (song_id text primary key, rating_pst integer, rating_prs integer,
+        rating_ftr integer, rating_byn integer, rating_etr integer)''',
+    # 上次更新user_char_full时的角色数据，用于只更新变化的角色
+    '''create table if not exists web_character_snapshot (character_id integer primary key, max_level integer,
+        is_uncapped integer)''',
+    # 兑换码数据的版本号，redeem、redeem_item、user_redeem变化时由触发器加一，用于判断统计的缓存是否失效
+    '''create table if not exists web_redeem_version (id integer primary key check (id = 0), version integer)''',
+    '''insert or ignore into web_redeem_version values (0, 0)''',
+)
+
+# 触发器写入的表，须与触发器在同一个事务中确认存在
+TRIGGER_TABLES = ('web_user_potential', 'web_redeem_version')
+
+INDEXES = (
+    # 玩家列表按ptt分页
+    '''create index if not exists web_user_rating_ptt on user (rating_ptt desc, user_id)''',
+    # 单个谱面排行榜分页
+    '''create index if not exists web_best_score_rank on best_score (song_id, difficulty, score desc, time_played desc)''',
+    # 兑换码使用情况按code分组统计
+    '''create index if not exists web_user_redeem_code on user_redeem (code)''',
+)
+
+# 注意：这些触发器建在游戏数据库的best_score、recent30与兑换码的表上，游戏服务端写入时同样会执行。
+# SQLite建触发器时不检查触发器内的语句，TRIGGER_TABLES不存在时所有写这些表的操作都会失败，
+# 所以它们与这些表在同一个事务中创建，建表失败时删除触发器
+REDEEM_TABLES = ('redeem', 'redeem_item', 'user_redeem')
+
+TRIGGER_NAMES = tuple(f'web_user_potential_{table}_{event}'
+                      for table in ('best_score', 'recent30')
+                      for event in ('insert', 'update', 'delete')) + \
+    tuple(f'web_redeem_version_{table}_{event}'
+          for table in REDEEM_TABLES
+          for event in ('insert', 'update', 'delete'))
+
+TRIGGERS = tuple(
+    f'''create trigger if not exists web_user_potential_{table}_{event} after {event} on {table}
+        begin delete from web_user_potential where user_id = {row}.user_id; end'''
+    for table in ('best_score', 'recent30')
+    for event, row in (('insert', 'new'), ('update', 'old'), ('delete', 'old'))
+) + tuple(
+    f'''create trigger if not exists web_redeem_version_{table}_{event} after {event} on {table}
+        begin update web_redeem_version set version = version + 1 where id = 0; end'''
+    for table in REDEEM_TABLES
+    for event in ('insert', 'update', 'delete')
+)
+
+
+def ensure_schema(logger=None) -> None:
+    # 启动时创建缺少的表、索引与触发器，已存在时不做任何事
+    conn = sqlite3.connect(Config.SQLITE_DATABASE_PATH,
+                           timeout=30, isolation_level=None)
+    try:
+        for sql in INDEXES:
+            try:
+                conn.execute(sql)
+            except sqlite3.Error:
+                if logger:
+                    logger.warning(f'Failed to create schema object: {sql}')
+        try:
+            conn.execute('''begin immediate''')
+            for sql in TABLES:
+                conn.execute(sql)
+            # 同名的视图等已存在时create table if not exists也不会报错
+            for name in TRIGGER_TABLES:
+                if conn.execute('''select 1 from sqlite_master where type = 'table' and name = ?''',
+                                (name,)).fetchone() is None:
+                    raise sqlite3.OperationalError(f'{name} is not a table.')
+            for sql in TRIGGERS:
+                conn.execute(sql)
+            conn.execute('''commit''')
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('''rollback''')
+            if logger:
+                logger.exception(
+                    'Failed to create web tables, dropping the triggers that depend on them.')
+            # 已有的触发器也要删除，否则表缺失时游戏写成绩会失败
+            for name in TRIGGER_NAMES:
+                try:
+                    conn.execute(f'''drop trigger if exists {name}''')
+                except sqlite3.Error:
+                    if logger:
+                        logger.error(f'Failed to drop trigger `{name}`.')
+    finally:
+        conn.close()
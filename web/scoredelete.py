@@ -0,0 +1,98 @@
+import time
+
+from core.sql import Connect
+
+from .recompute import recompute_rating_ptt
+
+
+class ScoreDelete:
+    '''
+        按歌曲、难度、玩家批量删除best_score\
+        `preview`先统计受影响的行数，按玩家与谱面分组；`run`按rowid分块删除，每块单独提交，
+        删除后（包括被取消或中断时）分批重算受影响玩家的rating_ptt\
+        条件为None时表示不限制，三个条件不能都为None
+    '''
+
+    def __init__(self, song_id: str = None, difficulty: int = None, user_id: int = None,
+                 chunk_size: int = 2000, pause: float = 0.01) -> None:
+        if song_id is None and difficulty is None and user_id is None:
+            raise ValueError('At least one condition is required.')
+        self.song_id = song_id
+        self.difficulty = difficulty
+        self.user_id = user_id
+        self.chunk_size = chunk_size
+        self.pause = pause
+
+    def where(self):
+        where = []
+        args = {}
+        if self.song_id is not None:
+            where.append('song_id = :song_id')
+            args['song_id'] = self.song_id
+        if self.difficulty is not None:
+            where.append('difficulty = :difficulty')
+            args['difficulty'] = self.difficulty
+        if self.user_id is not None:
+            where.append('user_id = :user_id')
+            args['user_id'] = self.user_id
+        return ' and '.join(where), args
+
+    def preview(self, limit: int = 20) -> dict:
+        '''受影响的总行数、玩家数、谱面数，以及行数最多的前`limit`个玩家与谱面'''
+        where, args = self.where()
+        args['limit'] = limit
+        with Connect() as c:
+            c.execute(f'''select count(*), count(distinct user_id) from best_score where {where}''', args)
+            total, user_count = c.fetchone()
+            c.execute(f'''select count(*) from (select 1 from best_score where {where}
+                group by song_id, difficulty)''', args)
+            chart_count = c.fetchone()[0]
+            c.execute(f'''select b.user_id, u.name, b.n from (select user_id, count(*) as n from best_score
+                where {where} group by user_id order by n desc limit :limit) b
+                left join user u on u.user_id = b.user_id order by b.n desc''', args)
+            users = [{'user_id': x[0], 'name': x[1], 'count': x[2]}
+                     for x in c.fetchall()]
+            c.execute(f'''select song_id, difficulty, count(*) as n from best_score where {where}
+                group by song_id, difficulty order by n desc limit :limit''', args)
+            charts = [{'song_id': x[0], 'difficulty': x[1], 'count': x[2]}
+                      for x in c.fetchall()]
+        return {'total': total, 'user_count': user_count, 'chart_count': chart_count,
+                'users': users, 'charts': charts}
+
+    def run(self, progress=None) -> str:
+        '''`progress(done, total, message)`为进度回调，返回统计信息'''
+        where, args = self.where()
+        with Connect() as c:
+            c.execute(
+                f'''select distinct user_id from best_score where {where}''', args)
+            user_ids = [x[0] for x in c.fetchall()]
+            c.execute(f'''select count(*) from best_score where {where}''', args)
+            total = c.fetchone()[0]
+
+        args['limit'] = self.chunk_size
+        deleted = 0
+        try:
+            while True:
+                with Connect() as c:
+                    c.execute(f'''delete from best_score where rowid in
+                        (select rowid from best_score where {where} limit :limit)''', args)
+                    n = c.rowcount
+                if n <= 0:
+                    break
+                deleted += n
+                if progress is not None:
+                    progress(deleted, total, f'{deleted} rows deleted')
+                if self.pause:
+                    time.sleep(self.pause)
+        finally:
+            # 取消或中断时已提交的块不会回滚，同样要重算，否则rating_ptt仍包含已删除的成绩
+            self.recompute(user_ids)
+        return f'{deleted} rows deleted, rating_ptt of {len(user_ids)} users recomputed'
+
+    def recompute(self, user_ids, chunk_size: int = 500) -> None:
+        '''分批重算rating_ptt，每批单独提交'''
+        for i in range(0, len(user_ids), chunk_size):
+            with Connect() as c:
+                recompute_rating_ptt(c, user_ids[i:i + chunk_size])
+            if self.pause:
+                time.sleep(self.pause)
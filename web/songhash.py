@@ -0,0 +1,185 @@
+import hashlib
+import json
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from time import perf_counter
+
+from core.config_manager import Config
+from core.constant import Constant
+
+from .config import WebConfig
+from .native import native
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def file_md5(path: str) -> str:
+    # 整个文件映射到内存后一次计算，hashlib计算时会释放GIL
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return hashlib.md5().hexdigest()
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return hashlib.md5(m).hexdigest()
+        except (OSError, ValueError):
+            h = hashlib.md5()
+            while True:
+                data = f.read(BUFFER_SIZE)
+                if not data:
+                    break
+                h.update(data)
+            return h.hexdigest()
+
+
+def _hash_one(path: str):
+    try:
+        return file_md5(path)
+    except OSError:
+        return None
+
+
+class SongHashManifest:
+    '''
+        歌曲文件md5的清单：相对路径 -> (size, mtime_ns, md5)，保存在游戏数据库旁的json文件中\
+        刷新时只计算大小或修改时间变化的文件，多个文件时用进程池并行计算\
+        `install`后`core.download.get_song_file_md5`先查清单，文件未变化时不再读取文件
+    '''
+
+    def __init__(self, root: str, path: str = None, processes: int = 0) -> None:
+        self.root = root
+        self._path = path
+        self.processes = processes or os.cpu_count() or 1
+        self.files = {}
+        self.loaded = False
+        self.dirty = False  # 有未保存的变化
+        self._lock = native('threading', 'Lock')()
+
+    @property
+    def path(self) -> str:
+        return self._path or os.path.join(
+            os.path.dirname(Config.SQLITE_DATABASE_PATH) or '.', 'web_song_hash.json')
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.files = {k: tuple(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError):
+            self.files = {}
+        self.loaded = True
+
+    def save(self) -> None:
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with self._lock:
+            files = dict(self.files)
+            self.dirty = False
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(files, f)
+        os.replace(tmp, self.path)
+
+    def _executor(self, n: int):
+        # gevent打过补丁时进程池的管理线程不可用，concurrent.futures的线程池也会变成协程，
+        # 改用gevent线程池，它的工作线程是原生线程，hashlib计算时释放GIL可以并行，等待结果时不阻塞事件循环
+        try:
+            from gevent import monkey  # type: ignore
+            if monkey.is_module_patched('threading'):
+                from gevent.threadpool import ThreadPoolExecutor  # type: ignore
+                return ThreadPoolExecutor(min(n, self.processes))
+        except ImportError:
+            pass
+        return ProcessPoolExecutor(min(n, self.processes))
+
+    def refresh(self, progress=None) -> str:
+        '''重新扫描目录，只计算变化的文件，返回统计信息'''
+        t = perf_counter()
+        if not self.loaded:
+            self.load()
+        root = os.path.abspath(self.root)
+        files = {}
+        changed = []  # [(相对路径, 绝对路径, size, mtime_ns)]
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                rel = os.path.relpath(path, root).replace(os.sep, '/')
+                x = self.files.get(rel)
+                if x is not None and x[0] == st.st_size and x[1] == st.st_mtime_ns:
+                    files[rel] = x
+                else:
+                    changed.append((rel, path, st.st_size, st.st_mtime_ns))
+
+        size = sum(i[2] for i in changed)
+        if len(changed) > 1 and self.processes > 1:
+            with self._executor(len(changed)) as executor:
+                digests = executor.map(
+                    _hash_one, [i[1] for i in changed], chunksize=8)
+                for n, (x, digest) in enumerate(zip(changed, digests), 1):
+                    if digest is not None:
+                        files[x[0]] = (x[2], x[3], digest)
+                    if progress is not None:
+                        progress(n, len(changed), f'{n}/{len(changed)} files')
+        else:
+            for n, x in enumerate(changed, 1):
+                digest = _hash_one(x[1])
+                if digest is not None:
+                    files[x[0]] = (x[2], x[3], digest)
+                if progress is not None:
+                    progress(n, len(changed), f'{n}/{len(changed)} files')
+
+        with self._lock:
+            self.files = files
+        self.save()
+        return f'{len(files)} files, {len(changed)} hashed ({size / 1024 / 1024:.1f} MiB), {perf_counter() - t:.1f}s'
+
+    def get(self, rel_path: str):
+        '''文件未变化时返回清单中的md5，否则重新计算并更新清单，文件不存在时返回None'''
+        if not self.loaded:
+            self.load()
+        path = os.path.join(self.root, rel_path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        x = self.files.get(rel_path)
+        if x is not None and x[0] == st.st_size and x[1] == st.st_mtime_ns:
+            return x[2]
+        if not os.path.isfile(path):
+            return None
+        digest = file_md5(path)
+        with self._lock:
+            self.files[rel_path] = (st.st_size, st.st_mtime_ns, digest)
+            self.dirty = True
+        return digest
+
+    def install(self) -> bool:
+        '''
+            替换`core.download.get_song_file_md5`，服务端没有该函数时返回False\
+            与原函数一样带缓存，服务端刷新谱面缓存时调用`cache_clear`清空
+        '''
+        try:
+            from core import download
+        except ImportError:
+            return False
+        original = getattr(download, 'get_song_file_md5', None)
+        if original is None or getattr(original, '__wrapped_by_manifest__', False):
+            return original is not None
+
+        maxsize = original.cache_info().maxsize if hasattr(
+            original, 'cache_info') else 8192
+
+        @lru_cache(maxsize=maxsize)
+        def get_song_file_md5(song_id: str, file_name: str):
+            return self.get(f'{song_id}/{file_name}')
+
+        get_song_file_md5.__wrapped_by_manifest__ = True
+        download.get_song_file_md5 = get_song_file_md5
+        return True
+
+
+song_hash_manifest = SongHashManifest(
+    Constant.SONG_FILE_FOLDER_PATH, processes=WebConfig.SONG_HASH_PROCESSES)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+from time import perf_counter
+
+import core.init
+from core.config_manager import Config
+from core.init import FileChecker
+
+
+class StartupTimer:
+    '''记录启动各阶段的耗时'''
+
+    def __init__(self, start: float = None) -> None:
+        self.start = perf_counter() if start is None else start
+        self.phases = []  # [(阶段名, 秒)]
+        self._last = self.start
+
+    def mark(self, name: str) -> None:
+        # 记录从上一个阶段结束到现在的耗时
+        now = perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def summary(self) -> str:
+        r = ', '.join(f'{name} {t:.2f}s' for name, t in self.phases)
+        return f'{r}, total {self._last - self.start:.2f}s'
+
+
+class CachedFileChecker:
+    '''
+        带缓存的运行前检查\
+        完整检查通过后保存数据库结构、配置与歌曲/热更新文件目录的指纹，
+        下次启动时指纹不变则跳过`FileChecker`的完整检查\
+        跳过时仍会初始化内存数据库与热更新信息，歌曲文件的hash在用到时再计算
+    '''
+
+    def __init__(self, logger=None, fingerprint_path: str = None) -> None:
+        self.logger = logger
+        self.fingerprint_path = fingerprint_path or os.path.join(
+            os.path.dirname(Config.SQLITE_DATABASE_PATH) or '.', 'web_filecheck.json')
+        self.skipped = False
+
+    def check_before_run(self) -> bool:
+        fingerprint = self.fingerprint()
+        if fingerprint is not None and fingerprint == self._load():
+            try:
+                self._init_runtime()
+                self.skipped = True
+                return True
+            except Exception:
+                if self.logger:
+                    self.logger.exception(
+                        'Fast start failed, running full file check.')
+
+        if not FileChecker(self.logger).check_before_run():
+            return False
+        # 完整检查可能升级了数据库，重新计算
+        self._save(self.fingerprint())
+        return True
+
+    def fingerprint(self):
+        '''数据库结构、配置与文件目录的指纹，数据库不存在时返回None'''
+        if not os.path.isfile(Config.SQLITE_DATABASE_PATH):
+            return None
+        h = hashlib.sha256()
+        try:
+            conn = sqlite3.connect(
+                f'file:{Config.SQLITE_DATABASE_PATH}?mode=ro', uri=True)
+            try:
+                for x in conn.execute('''select type, name, sql from sqlite_master order by type, name'''):
+                    h.update(repr(x).encode())
+                h.update(repr(conn.execute(
+                    '''pragma user_version''').fetchone()).encode())
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+
+        config = {k: repr(getattr(Config, k))
+                  for k in dir(Config) if k.isupper()}
+        h.update(json.dumps(config, sort_keys=True).encode())
+
+        # 服务端代码更新后也需要完整检查
+        for path in (core.init.__file__, getattr(Config, 'DATABASE_INIT_PATH', None)):
+            if path:
+                self._update_tree(h, path)
+        for path in (Config.SONG_FILE_FOLDER_PATH, Config.CONTENT_BUNDLE_FOLDER_PATH):
+            self._update_tree(h, path)
+        return h.hexdigest()
+
+    @staticmethod
+    def _update_tree(h, path: str) -> None:
+        # 文件名、大小与修改时间，不读文件内容
+        if os.path.isfile(path):
+            st = os.stat(path)
+            h.update(f'{path}|{st.st_size}|{st.st_mtime_ns}\n'.encode())
+            return
+        h.update(f'{path}\n'.encode())
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                p = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                h.update(
+                    f'{os.path.relpath(p, path)}|{st.st_size}|{st.st_mtime_ns}\n'.encode())
+
+    def _init_runtime(self) -> None:
+        # 完整检查中每次启动都必须做的部分
+        from core import sql
+        if hasattr(sql, 'MemoryDatabase'):
+            sql.MemoryDatabase()
+        from core.operation import RefreshBundleCache
+        RefreshBundleCache().run()
+
+    def _load(self):
+        try:
+            with open(self.fingerprint_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('fingerprint')
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, fingerprint) -> None:
+        if fingerprint is None:
+            return
+        try:
+            with open(self.fingerprint_path, 'w', encoding='utf-8') as f:
+                json.dump({'fingerprint': fingerprint}, f)
+        except OSError:
+            if self.logger:
+                self.logger.warning(
+                    f'Cannot save file check fingerprint to {self.fingerprint_path}.')
@@ -1,8 +1,24 @@
 import hashlib
+import os
+import sqlite3
 import time
+from itertools import groupby
+from operator import itemgetter
 from random import Random
 
+from core.operation import (RefreshBundleCache, RefreshSongFileCache, SaveUpdateScore,
+                            UnlockUserItem)
 from core.sql import Connect
+from web.download import bundle_token_cache
+from web.fileserve import bundle_manifest, song_manifest
+from web.chart_search import chart_search
+from web.cache import TTLCache
+from web.config import WebConfig
+from web.dbmerge import DatabaseMerge
+from web.jobs import job_runner
+from web.recompute import ScoreRatingRecompute
+from web.scoredelete import ScoreDelete
+from web.songhash import song_hash_manifest
 
 
 def int2b(x):
@@ -24,20 +40,112 @@ def random_str(randomlength=10):
     return s
 
 
-def update_user_char(c):
-    # 用character数据更新user_char_full
-    c.execute('''select character_id, max_level, is_uncapped from character''')
-    x = c.fetchall()
-    c.execute('''select user_id from user''')
-    y = c.fetchall()
-    if x and y:
-        for j in y:
-            for i in x:
-                c.execute('''delete from user_char_full where user_id=:a and character_id=:b''', {
-                          'a': j[0], 'b': i[0]})
-                exp = 25000 if i[1] == 30 else 10000
-                c.execute('''insert into user_char_full values(?,?,?,?,?,?,?)''',
-                          (j[0], i[0], i[1], exp, i[2], 0))
+def refresh_song_file_cache():
+    # 刷新谱面文件缓存，并重建下载用的文件清单
+    RefreshSongFileCache().run()
+    song_manifest.build()
+
+
+def refresh_bundle_cache():
+    # 刷新热更新缓存，重建下载用的文件清单，并清空token解析缓存
+    RefreshBundleCache().run()
+    bundle_manifest.build()
+    bundle_token_cache.clear()
+
+
+# 以下为后台任务，由对应的页面加入队列
+
+@job_runner.register('refresh_song_file_cache', '刷新歌曲哈希值')
+def refresh_song_file_cache_job(ctx):
+    r = None
+    if WebConfig.SONG_HASH_MANIFEST:
+        # 先只计算变化的文件并逐个报告进度，服务端刷新缓存时直接读清单
+        r = song_hash_manifest.refresh(ctx.progress)
+    ctx.progress(0, 1, 'refreshing song file cache')
+    refresh_song_file_cache()
+    return r
+
+
+@job_runner.register('refresh_all_score_rating', '刷新歌曲的评分')
+def refresh_all_score_rating_job(ctx, only_changed=False):
+    return ScoreRatingRecompute(WebConfig.RECOMPUTE_CHUNK_SIZE, WebConfig.RECOMPUTE_PAUSE,
+                                only_changed).run(ctx.progress)
+
+
+@job_runner.register('save_update_score', '全部用户存档同步')
+def save_update_score_job(ctx):
+    # 服务端一次集合操作处理全部玩家，比逐个玩家同步快得多；只能在开始前取消
+    ctx.progress(0, 1, 'syncing all user saves')
+    SaveUpdateScore().run()
+
+
+@job_runner.register('unlock_user_item', '全部用户解锁购买')
+def unlock_user_item_job(ctx):
+    # 同上，一次处理全部玩家
+    ctx.progress(0, 1, 'unlocking items for all users')
+    UnlockUserItem().run()
+
+
+@job_runner.register('update_database', '旧数据库同步')
+def update_database_job(ctx, path, dry_run=False):
+    m = DatabaseMerge(path, chunk_size=WebConfig.DATABASE_MERGE_CHUNK_SIZE)
+    if dry_run:
+        return m.diff(ctx.progress)
+    r = []
+    if WebConfig.DATABASE_MERGE_BACKUP:
+        r.append(f'backup: {m.backup(ctx.progress)}')
+    r.append(m.run(ctx.progress))
+    r.append(update_user_char(chunk_size=WebConfig.USER_CHAR_CHUNK_SIZE,
+                              progress=ctx.progress))
+    os.remove(path)
+    chart_search.invalidate()
+    return '\n'.join(r)
+
+
+@job_runner.register('delete_scores', '批量删除成绩')
+def delete_scores_job(ctx, song_id=None, difficulty=None, user_id=None):
+    return ScoreDelete(song_id, difficulty, user_id, WebConfig.RECOMPUTE_CHUNK_SIZE,
+                       WebConfig.RECOMPUTE_PAUSE).run(ctx.progress)
+
+
+@job_runner.register('update_user_char', '更新所有用户拥有的角色')
+def update_user_char_job(ctx, only_changed=False):
+    return update_user_char(only_changed, WebConfig.USER_CHAR_CHUNK_SIZE, ctx.progress)
+
+
+def update_user_char(only_changed=False, chunk_size=200, progress=None):
+    # 用character数据更新user_char_full，每次处理chunk_size个用户，用一条insert ... select写入
+    # only_changed为True时只更新max_level或is_uncapped与上次不同的角色，没有上次的记录时全部更新
+    with Connect() as c:
+        c.execute('''select character_id, max_level, is_uncapped from character''')
+        chars = c.fetchall()
+        c.execute('''select character_id, max_level, is_uncapped from web_character_snapshot''')
+        snapshot = {i[0]: tuple(i) for i in c.fetchall()}
+        c.execute('''select user_id from user order by user_id''')
+        users = [i[0] for i in c.fetchall()]
+
+    if only_changed and snapshot:
+        chars = [i for i in chars if snapshot.get(i[0]) != tuple(i)]
+    if not chars or not users:
+        return '0 characters updated'
+
+    char_ids = [i[0] for i in chars]
+    where = f'''character_id in ({','.join('?' * len(char_ids))})'''
+    for i in range(0, len(users), chunk_size):
+        first, last = users[i], users[min(i + chunk_size, len(users)) - 1]
+        with Connect() as c:
+            c.execute(f'''delete from user_char_full where user_id between ? and ? and {where}''',
+                      (first, last, *char_ids))
+            c.execute(f'''insert into user_char_full (user_id, character_id, level, exp, is_uncapped, is_uncapped_override)
+                select u.user_id, c.character_id, c.max_level, case when c.max_level = 30 then 25000 else 10000 end,
+                c.is_uncapped, 0 from user u, character c where u.user_id between ? and ? and c.{where}''',
+                      (first, last, *char_ids))
+        if progress is not None:
+            progress(min(i + chunk_size, len(users)), len(users))
+
+    with Connect() as c:
+        c.executemany('''insert or replace into web_character_snapshot values(?,?,?)''', chars)
+    return f'{len(chars)} characters updated for {len(users)} users'
 
 
 def get_all_item():
@@ -56,47 +164,171 @@ def get_all_item():
     return re
 
 
-def get_all_purchase():
-    # 所有购买数据查询
-    with Connect() as c:
-        c.execute('''select * from purchase''')
-        x = c.fetchall()
-        re = []
-        if x:
-            for i in x:
+def get_rows_with_items(c, table, item_table, key, after=None, limit=-1):
+    # 按key分页读取table，再用一次查询取出这些行在item_table中的物品，返回[(行, [物品])]
+    # after为上一页最后一行的key，limit为-1时不分页
+    if after is None:
+        c.execute(f'''select * from {table} order by {key} limit :b''', {'b': limit})
+    else:
+        c.execute(f'''select * from {table} where {key} > :a order by {key} limit :b''',
+                  {'a': after, 'b': limit})
+    x = c.fetchall()
+    if not x:
+        return []
 
-                discount_from = None
-                discount_to = None
-                discount_reason = 'Yes' if i[5] == 'anni5tix' else 'No'
-
-                if i[3] and i[3] >= 0:
-                    discount_from = time.strftime(
-                        "%Y-%m-%d %H:%M:%S", time.localtime(int(i[3])/1000))
-                if i[4] and i[4] >= 0:
-                    discount_to = time.strftime(
-                        "%Y-%m-%d %H:%M:%S", time.localtime(int(i[4])//1000))
-
-                c.execute(
-                    '''select * from purchase_item where purchase_name=?''', (i[0],))
-                y = c.fetchall()
-                items = []
-                if y:
-                    for j in y:
-                        items.append(
-                            {'item_id': j[1], 'type': j[2], 'amount': j[3]})
-
-                re.append({'purchase_name': i[0],
-                           'price': i[1],
-                           'orig_price': i[2],
-                           'discount_from': discount_from,
-                           'discount_to': discount_to,
-                           'discount_reason': discount_reason,
-                           'items': items
-                           })
+    if limit < 0 and after is None:
+        c.execute(f'''select * from {item_table}''')
+    else:
+        # 一页的key是连续的一段
+        c.execute(f'''select * from {item_table} where {key} between :a and :b''',
+                  {'a': x[0][0], 'b': x[-1][0]})
+    items = {}
+    for j in c.fetchall():
+        items.setdefault(j[0], []).append(
+            {'item_id': j[1], 'type': j[2], 'amount': j[3]})
+    return [(i, items.get(i[0], [])) for i in x]
+
+
+def count_rows_with_items(c, table, item_table, key):
+    # 只统计数量：总行数，以及按物品类型统计的物品条数与总数量
+    c.execute(f'''select count(*) from {table}''')
+    total = c.fetchone()[0]
+    c.execute(f'''select i.type, count(*), sum(i.amount) from {item_table} i
+        join {table} t on t.{key} = i.{key} group by i.type order by i.type''')
+    return {'total': total,
+            'items': [{'type': i[0], 'count': i[1], 'amount': i[2]} for i in c.fetchall()]}
+
+
+def get_all_purchase(after=None, limit=-1):
+    # 购买数据查询，按purchase_name分页
+    with Connect() as c:
+        x = get_rows_with_items(
+            c, 'purchase', 'purchase_item', 'purchase_name', after, limit)
+    re = []
+    for i, items in x:
+        discount_from = None
+        discount_to = None
+        discount_reason = 'Yes' if i[5] == 'anni5tix' else 'No'
+
+        if i[3] and i[3] >= 0:
+            discount_from = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(int(i[3])/1000))
+        if i[4] and i[4] >= 0:
+            discount_to = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(int(i[4])//1000))
+
+        re.append({'purchase_name': i[0],
+                   'price': i[1],
+                   'orig_price': i[2],
+                   'discount_from': discount_from,
+                   'discount_to': discount_to,
+                   'discount_reason': discount_reason,
+                   'items': items
+                   })
 
     return re
 
 
+def get_all_present(after=None, limit=-1):
+    # 奖励数据查询，按present_id分页
+    with Connect() as c:
+        x = get_rows_with_items(
+            c, 'present', 'present_item', 'present_id', after, limit)
+    return [{'present_id': i[0],
+             'expire_ts': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(i[1])//1000)),
+             'items': items,
+             'description': i[2]
+             } for i, items in x]
+
+
+def get_all_redeem(after=None, limit=-1):
+    # 兑换码数据查询，按code分页
+    with Connect() as c:
+        x = get_rows_with_items(c, 'redeem', 'redeem_item', 'code', after, limit)
+    return [{'code': i[0],
+             'items': items,
+             'type': i[1]
+             } for i, items in x]
+
+
+def get_items_summary(table, item_table, key):
+    # 购买/奖励/兑换码的数量统计
+    with Connect() as c:
+        return count_rows_with_items(c, table, item_table, key)
+
+
+def get_redeem_usage(after=None, limit=-1, used_only=False):
+    # 每个兑换码的使用次数，按code分页，一次分组查询，依赖user_redeem(code)上的索引
+    # after为上一页最后一个code，limit为-1时不分页
+    with Connect() as c:
+        c.execute(f'''select r.code, r.type, count(u.code) as n from redeem r
+            left join user_redeem u on u.code = r.code where r.code > :a
+            group by r.code {'having n > 0' if used_only else ''} order by r.code limit :b''',
+                  {'a': '' if after is None else after, 'b': limit})
+        return [{'code': i[0], 'type': i[1], 'used': i[2]} for i in c.fetchall()]
+
+
+def iter_redeem_usage(used_only=False, chunk_size=5000):
+    # 导出用，逐页读取全部兑换码的使用次数，每页单独查询，不长时间占用数据库
+    after = None
+    while True:
+        x = get_redeem_usage(after, chunk_size, used_only)
+        yield from x
+        if len(x) < chunk_size:
+            return
+        after = x[-1]['code']
+
+
+def _redeem_fingerprint(c):
+    # 用于判断批次统计的缓存是否失效：触发器维护的版本号，兑换码数据有任何变化时加一，只读一行
+    # 建表失败没有版本号时退回各表的最大rowid，删除要等缓存过期后才能看到
+    try:
+        c.execute('''select version from web_redeem_version where id = 0''')
+        return c.fetchone()
+    except sqlite3.Error:
+        c.execute('''select (select max(rowid) from redeem), (select max(rowid) from redeem_item),
+            (select max(rowid) from user_redeem)''')
+        return c.fetchone()
+
+
+def _count_redeem_batches(c):
+    # 一次按code顺序的连接查询，每个code的物品排序后拼接，保证同一组物品总得到相同的字符串
+    c.execute('''select code, count(*) from user_redeem group by code''')
+    used = dict(c.fetchall())
+    c.execute('''select r.code, r.type, i.item_id || ':' || i.type || ':' || i.amount from redeem r
+        left join redeem_item i on i.code = r.code order by r.code''')
+    batches = {}
+    for code, rows in groupby(c, key=itemgetter(0)):
+        rows = list(rows)
+        key = (rows[0][1], ', '.join(sorted(i[2] for i in rows if i[2] is not None)))
+        n = used.get(code, 0)
+        x = batches.get(key)
+        if x is None:
+            x = batches[key] = [0, 0, 0]
+        x[0] += 1
+        x[1] += n > 0
+        x[2] += n
+    r = [{'type': k[0], 'items': k[1], 'codes': v[0], 'used_codes': v[1], 'used': v[2]}
+         for k, v in batches.items()]
+    r.sort(key=lambda i: (-i['codes'], i['type'], i['items']))
+    return r
+
+
+_redeem_batches = TTLCache(1, WebConfig.REDEEM_BATCH_USAGE_TTL)
+
+
+def get_redeem_batch_usage(offset=0, limit=-1):
+    # 按批次统计：类型与物品完全相同的兑换码视为同一批，返回每批的兑换码数、已使用的兑换码数与使用次数
+    # 统计需要扫描全部兑换码，结果按版本号缓存，翻页只取缓存的切片；limit为-1时不分页
+    with Connect() as c:
+        key = _redeem_fingerprint(c)
+        x = _redeem_batches.get(key)
+        if x is None:
+            x = _count_redeem_batches(c)
+            _redeem_batches.set(key, x)
+    return x[offset:] if limit < 0 else x[offset:offset + limit]
+
+
 def add_one_present(present_id, expire_ts, description, item_id, item_type, item_amount):
     # 添加一个奖励
 
@@ -163,18 +395,44 @@ def deliver_one_user_present(c, present_id, user_id):
     return
 
 
-def deliver_all_user_present(c, present_id):
-    # 为所有玩家添加奖励
-    c.execute('''select user_id from user''')
-    x = c.fetchall()
-    if x:
-        c.execute('''delete from user_present where present_id=:b''',
-                  {'b': present_id})
-        for i in x:
-            c.execute('''insert into user_present values(:a,:b)''',
-                      {'a': i[0], 'b': present_id})
+def deliver_all_user_present(present_id, min_ptt=None, max_ptt=None, join_after=None, join_before=None,
+                             exclude_banned=False, chunk_size=5000):
+    # 为所有符合条件的玩家添加奖励，已有该奖励的玩家跳过，返回新分发的玩家数
+    # 按user_id分段，每段一条insert ... select并单独提交
+    # min_ptt、max_ptt与user表的rating_ptt单位相同，join_after、join_before为毫秒时间戳
+    where = ['''user_id >= :a and user_id < :b''',
+             '''not exists (select 1 from user_present p where p.user_id = user.user_id and p.present_id = :present_id)''']
+    args = {'present_id': present_id}
+    if min_ptt is not None:
+        where.append('rating_ptt >= :min_ptt')
+        args['min_ptt'] = min_ptt
+    if max_ptt is not None:
+        where.append('rating_ptt <= :max_ptt')
+        args['max_ptt'] = max_ptt
+    if join_after is not None:
+        where.append('join_date >= :join_after')
+        args['join_after'] = join_after
+    if join_before is not None:
+        where.append('join_date < :join_before')
+        args['join_before'] = join_before
+    if exclude_banned:
+        where.append("password != ''")
+    sql = f'''insert into user_present (user_id, present_id) select user_id, :present_id from user
+        where {' and '.join(where)}'''
 
-    return
+    with Connect() as c:
+        c.execute('''select min(user_id), max(user_id) from user''')
+        first, last = c.fetchone()
+    if first is None:
+        return 0
+    delivered = 0
+    for a in range(first, last + 1, chunk_size):
+        args['a'] = a
+        args['b'] = a + chunk_size
+        with Connect() as c:
+            c.execute(sql, args)
+            delivered += c.rowcount
+    return delivered
 
 
 def add_one_redeem(code, redeem_type, item_id, item_type, item_amount):
@@ -202,29 +460,33 @@ def add_one_redeem(code, redeem_type, item_id, item_type, item_amount):
 
 
 def add_some_random_redeem(amount, redeem_type, item_id, item_type, item_amount):
-    # 随机生成一堆10位的兑换码
+    # 随机生成一堆10位的兑换码，返回(提示信息, 生成的兑换码列表)
+    # 已有的兑换码一次读入内存去重，生成的兑换码在一个事务中用executemany写入
 
-    message = None
+    chars = 'AaBbCcDdEeFfGgHhIiJjKkLlMmNnOoPpQqRrSsTtUuVvWwXxYyZz0123456789'
+    random = Random()
     with Connect() as c:
         c.execute(
             '''select exists(select * from item where item_id=? and type=?)''', (item_id, item_type))
         if c.fetchone() == (0,):
-            return '物品不存在 The item does not exist.'
-        i = 1
-        while i <= amount:
-            code = random_str()
-            c.execute(
-                '''select exists(select * from redeem where code=:a)''', {'a': code})
-            if c.fetchone() == (0,):
-                c.execute('''insert into redeem values(:a,:c)''',
-                          {'a': code, 'c': redeem_type})
-                c.execute('''insert into redeem_item values(?,?,?,?)''',
-                          (code, item_id, item_type, item_amount))
-                i += 1
-
-        message = '添加成功 Successfully add it.'
-
-    return message
+            return '物品不存在 The item does not exist.', []
+        c.execute('''select code from redeem''')
+        existing = {i[0] for i in c.fetchall()}
+
+        codes = []
+        seen = set()
+        while len(codes) < amount:
+            code = ''.join(random.choices(chars, k=10))
+            if code not in existing and code not in seen:
+                seen.add(code)
+                codes.append(code)
+
+        c.executemany('''insert into redeem values(?,?)''',
+                      ((code, redeem_type) for code in codes))
+        c.executemany('''insert into redeem_item values(?,?,?,?)''',
+                      ((code, item_id, item_type, item_amount) for code in codes))
+
+    return '添加成功 Successfully add it.', codes
 
 
 def delete_one_redeem(code):
@@ -5,13 +5,17 @@ import random
 import sqlite3
 import time
 from flask import Blueprint, current_app, flash, jsonify, redirect, render_template, request, session, url_for
-import markdown
 from core.error import DataExist, InputError
 from core.sql import Connect
 from core.user import UserRegister
 
 bp = Blueprint('user', __name__, url_prefix='/user')
 
+def render_markdown(content: str) -> str:
+    # markdown导入较慢，首次用到时才导入
+    import markdown
+    return markdown.markdown(content)
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 def index():
@@ -31,7 +35,7 @@ def news():
                     news_datetime = datetime.strptime(datetime_str, '%Y:%m:%d:%H:%M')
                     with open(os.path.join(news_folder, filename), 'r', encoding='utf-8') as f:
                         content = f.read()
-                    content_html = markdown.markdown(content)
+                    content_html = render_markdown(content)
                     news_items.append({
                         'title': title_part,
                         'datetime': news_datetime,
@@ -55,7 +59,7 @@ def news_detail(filename):
         news_datetime = datetime.strptime(datetime_str, '%Y:%m:%d:%H:%M')
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
-        content_html = markdown.markdown(content)
+        content_html = render_markdown(content)
         news_item = {
             'title': title_part,
             'datetime': news_datetime,
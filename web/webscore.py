@@ -1,78 +1,117 @@
+import json
+import sqlite3
 import time
 
 from core.score import Potential
+from core.user import User
 
+from .rows import record
 
-def get_user_score(c, user_id, limit=-1, offset=0):
-    # 返回用户的所有歌曲数据，带排名，返回字典列表
-    if limit >= 0:
-        c.execute('''select * from best_score where user_id =:a order by rating DESC limit :b offset :c''',
-                  {'a': user_id, 'b': limit, 'c': offset})
-    else:
-        c.execute(
-            '''select * from best_score where user_id =:a order by rating DESC''', {'a': user_id})
-    x = c.fetchall()
-    r = []
-    if x:
-        rank = 0
-        for i in x:
-            rank += 1
-            r.append({
-                "song_id": i[1],
-                "difficulty": i[2],
-                "score": i[3],
-                "shiny_perfect_count": i[4],
-                "perfect_count": i[5],
-                "near_count": i[6],
-                "miss_count": i[7],
-                "health": i[8],
-                "modifier": i[9],
-                "time_played": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(i[10])),
-                "best_clear_type": i[11],
-                "clear_type": i[12],
-                "rating": i[13],
-                "rank": rank
-            })
 
-    return r
+# 各页面用到的列，时间戳统一为秒，由模板的timestr过滤器格式化
+ScoreRow = record('ScoreRow', (
+    'song_id', 'difficulty', 'score', 'shiny_perfect_count', 'perfect_count', 'near_count', 'miss_count',
+    'health', 'modifier', 'time_played', 'best_clear_type', 'clear_type', 'rating', 'null as rank'),
+    times=('time_played',))
+
+PlayerRow = record('PlayerRow', (
+    'user_id', 'name', "password = '' as ban_flag", 'join_date / 1000 as join_date', 'user_code', 'rating_ptt',
+    'song_id', 'difficulty', 'score', 'shiny_perfect_count', 'perfect_count', 'near_count', 'miss_count',
+    'time_played / 1000 as time_played', 'clear_type', 'rating', 'ticket'),
+    times=('join_date', 'time_played'))
+
+ChartTopRow = record('ChartTopRow', (
+    'b.user_id', 'u.name', 'b.score', 'b.shiny_perfect_count', 'b.perfect_count', 'b.near_count',
+    'b.miss_count', 'b.time_played', 'b.best_clear_type', 'b.clear_type', 'b.rating', 'null as rank'),
+    times=('time_played',))
+
+
+def _ranked(rows, start=1):
+    # 按顺序填入排名
+    for rank, x in enumerate(rows, start):
+        x.rank = rank
+    return rows
+
+
+def get_user_score(c, user_id, limit=-1, offset=0):
+    # 返回用户的所有歌曲数据，带排名，按rating降序
+    c.execute(f'''select {ScoreRow.select} from best_score where user_id = :a order by rating desc limit :b offset :c''',
+              {'a': user_id, 'b': limit, 'c': offset})
+    return _ranked(ScoreRow.fetchall(c), offset + 1)
 
 
 def get_user(c, user_id):
-    # 得到user表部分用户信息，返回字典
-    c.execute('''select * from user where user_id = :a''', {'a': user_id})
-    x = c.fetchone()
-    r = None
+    # 得到user表部分用户信息，没有该用户时返回None
+    c.execute(f'''select {PlayerRow.select} from user where user_id = :a''', {'a': user_id})
+    return PlayerRow.fetchone(c)
+
+
+def get_players(c, status=None, after=None, limit=50):
+    # 按ptt降序分页返回玩家列表，after为上一页最后一位玩家的(rating_ptt, user_id)
+    # status: 'banned' 只看封禁的玩家，'active' 只看未封禁的玩家
+    where = []
+    args = {'limit': limit}
+    if status == 'banned':
+        where.append("password = ''")
+    elif status == 'active':
+        where.append("password != ''")
+    if after is not None:
+        where.append(
+            '(rating_ptt < :ptt or (rating_ptt = :ptt and user_id > :uid))')
+        args['ptt'], args['uid'] = after
+    c.execute(f'''select {PlayerRow.select} from user ''' + ('where ' + ' and '.join(where) if where else '') + '''
+        order by rating_ptt desc, user_id limit :limit''', args)
+    return PlayerRow.fetchall(c)
+
+
+def get_chart_top(c, song_id, difficulty, limit=50, offset=0):
+    # 单个谱面的排行榜，按分数与游玩时间排序，分页返回
+    c.execute(f'''select {ChartTopRow.select}
+        from best_score b join user u on u.user_id = b.user_id
+        where b.song_id = :a and b.difficulty = :b
+        order by b.score desc, b.time_played desc limit :c offset :d''',
+              {'a': song_id, 'b': difficulty, 'c': limit, 'd': offset})
+    return _ranked(ChartTopRow.fetchall(c), offset + 1)
+
+
+def get_user_potential(c, user_id):
+    # 玩家ptt详情：best30列表与均值、recent30列表与recent10均值
+    # 优先读web_user_potential缓存，缓存缺失时计算并写回
+    try:
+        c.execute('''select best_30, recent_10, best_30_list, recent_30_list from web_user_potential where user_id = :a''',
+                  {'a': user_id})
+        x = c.fetchone()
+    except sqlite3.Error:
+        x = None
     if x:
-        join_date = None
-        time_played = None
-        if x[3]:
-            join_date = time.strftime('%Y-%m-%d %H:%M:%S',
-                                      time.localtime(int(x[3])//1000))
-        if x[20]:
-            time_played = time.strftime('%Y-%m-%d %H:%M:%S',
-                                        time.localtime(int(x[20])//1000))
-        if x[2] == '':
-            ban_flag = True
-        else:
-            ban_flag = False
-
-        r = {'name': x[1],
-             'user_id': user_id,
-             'join_date': join_date,
-             'user_code': x[4],
-             'rating_ptt': x[5],
-             'song_id': x[11],
-             'difficulty': x[12],
-             'score': x[13],
-             'shiny_perfect_count': x[14],
-             'perfect_count': x[15],
-             'near_count': x[16],
-             'miss_count': x[17],
-             'time_played': time_played,
-             'clear_type': x[21],
-             'rating': x[22],
-             'ticket': x[26],
-             'ban_flag': ban_flag
-             }
+        return {'best_30': x[0], 'recent_10': x[1],
+                'best_30_list': json.loads(x[2]), 'recent_30_list': json.loads(x[3])}
 
+    posts = get_user_score(c, user_id, 30)
+    u = User()
+    u.user_id = user_id
+    p = Potential(c, u)
+    r = {'best_30': sum(i['rating'] for i in posts if i['rating']) / 30,
+         'recent_10': p.recent_10 / 10,
+         'best_30_list': posts,
+         'recent_30_list': p.recent_30_to_dict_list()}
+    try:
+        c.execute('''insert or replace into web_user_potential values(:a, :b, :c, :d, :e, :f)''',
+                  {'a': user_id, 'b': r['best_30'], 'c': r['recent_10'],
+                   'd': json.dumps([i.to_dict() for i in posts]), 'e': json.dumps(r['recent_30_list']),
+                   'f': int(time.time() * 1000)})
+    except (sqlite3.Error, TypeError, ValueError):
+        pass
     return r
+
+
+def clear_user_potential(c, user_id=None):
+    # 删除玩家ptt详情缓存，user_id为None时全部删除
+    try:
+        if user_id is None:
+            c.execute('''delete from web_user_potential''')
+        else:
+            c.execute('''delete from web_user_potential where user_id = :a''', {
+                      'a': user_id})
+    except sqlite3.Error:
+        pass